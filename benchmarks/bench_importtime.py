@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# Cold start benchmark, cumulative import time of the ecobee modules measured with python -X importtime in a
+# fresh interpreter per run. Compare against an older commit with --rev, e.g. --rev HEAD~1.
+# Run from the repository root: python benchmarks/bench_importtime.py [--rev <git ref>] [--runs 9] [--top 8]
+
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+MODULES = ['ecobee', 'ecobee.helpers', 'ecobee.supercool', 'ecobee.notifications', 'ecobee.pipeline']
+
+
+def export_rev(rev, target_dir):
+    # Extract the ecobee package of a git revision into target_dir
+    os.makedirs(target_dir)
+    archive = os.path.join(target_dir, 'rev.tar')
+    subprocess.run(['git', 'archive', '--format=tar', '-o', archive, rev, 'ecobee'], cwd=REPO_DIR, check=True)
+    with tarfile.open(archive) as tar:
+        tar.extractall(target_dir)
+    os.remove(archive)
+    return target_dir
+
+
+def has_module(module, source_dir):
+    # Modules added after the compared revision are reported as missing instead of failing the run
+    path = os.path.join(source_dir, *module.split('.'))
+    return os.path.exists(f'{path}.py') or os.path.exists(os.path.join(path, '__init__.py'))
+
+
+def import_times(module, source_dir, work_dir):
+    # Returns the microseconds spent on "import module" and {module name: cumulative microseconds} of everything
+    # it imported. Lines up to the site module are the interpreter's own startup and are skipped.
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([work_dir, source_dir]), PYTHONDONTWRITEBYTECODE='1')
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=work_dir, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    total = 0
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not cumulative.strip().isdigit():
+            continue
+        if name == ' site':
+            total = 0
+            times = {}
+            continue
+        if name.startswith(' ') and not name.startswith('  '):
+            # Top level imports (one space after the separator) add up to the cost of the statement
+            total += int(cumulative)
+        times[name.strip()] = int(cumulative)
+    return total, times
+
+
+def measure(module, source_dir, work_dir, runs):
+    # Median import time in ms and the median per imported module of the same runs
+    samples = [import_times(module, source_dir, work_dir) for _ in range(runs)]
+    names = set().union(*[times for _, times in samples])
+    dependencies = {name: statistics.median(times.get(name, 0) for _, times in samples) / 1000 for name in names}
+    return statistics.median(total for total, _ in samples) / 1000, dependencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the cold start import time of the ecobee modules.')
+    parser.add_argument('--rev', help='git revision to compare against')
+    parser.add_argument('--runs', type=int, default=9, help='interpreter starts per module (default 9)')
+    parser.add_argument('--top', type=int, default=0, help='show the slowest dependencies of each module')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='bench_importtime.')
+    try:
+        # Modules may import local_settings, the sample settings stand in for it
+        shutil.copy(os.path.join(REPO_DIR, 'sample_local_settings.py'), os.path.join(work_dir, 'local_settings.py'))
+        baseline_dir = export_rev(args.rev, os.path.join(work_dir, 'baseline')) if args.rev else None
+
+        header = f'{"module":<24} {"current":>10}'
+        if baseline_dir:
+            header += f' {args.rev:>12} {"speedup":>8}'
+        print(header)
+
+        for module in MODULES:
+            current, dependencies = measure(module, REPO_DIR, work_dir, args.runs)
+            line = f'{module:<24} {current:8.1f}ms'
+            if baseline_dir and not has_module(module, baseline_dir):
+                line += f' {"missing":>12}'
+            elif baseline_dir:
+                baseline, _ = measure(module, baseline_dir, work_dir, args.runs)
+                line += f' {baseline:10.1f}ms {baseline / current:7.1f}x'
+            print(line)
+
+            slowest = sorted(((ms, name) for name, ms in dependencies.items() if not name.startswith('ecobee')),
+                             reverse=True)
+            for ms, name in slowest[:args.top]:
+                print(f'    {name:<32} {ms:8.1f}ms')
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
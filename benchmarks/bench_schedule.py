@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# Micro-benchmarks for the 7x48 schedule compiler against the previous nested loop implementation.
+# Run from the repository root: python benchmarks/bench_schedule.py
+
+import os
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from ecobee import weekschedule  # NOQA: E402
+
+PROGRAM_DAY = [['sleep{0}', 760, '12:00'], ['precool{0}', 750, '12:30'], ['supercool{0}', 730, '16:00'],
+               ['away{0}', 820, '19:00'], ['home{0}', 770, '22:00'], ['sleepnight{0}', 760, '']]
+
+
+def get_program(days):
+    program = [[] for _ in range(7)]
+    for daynum in days:
+        program[daynum] = [[ref.format(daynum), temp, end] for ref, temp, end in PROGRAM_DAY]
+    program[(days[0] - 1) % 7] = [[f'sleepnight{(days[0] - 1) % 7}', 760, '22:00']]
+    return program
+
+
+def get_current_schedule():
+    return [['sleep'] * 48 for _ in range(7)]
+
+
+def legacy_get_time_slot(start_time, end_time=''):
+    # Previous helpers.get_time_slot (strptime based)
+    date_format = '%H:%M'
+
+    schedule_start = datetime.strptime('00:00', date_format)
+    start_time = datetime.strptime(start_time, date_format)
+    if not end_time:
+        end_time = start_time + timedelta(minutes=30)
+    else:
+        end_time = datetime.strptime(end_time, date_format)
+        if end_time < start_time:
+            raise Exception('End time can not be before start time')
+
+    start_slot = ((start_time - schedule_start).seconds / 60 / 60 / .5)
+    end_slot = ((end_time - schedule_start).seconds / 60 / 60 / .5)
+    if start_slot.is_integer() and end_slot.is_integer():
+        return int(start_slot), int(end_slot)
+
+
+def legacy_set_schedule(schedule, program):
+    # Previous Ecobee.set_thermostat_schedule loop
+    for idx, day in enumerate(program):
+        if len(day) == 0:
+            continue
+
+        last_time = '00:00'
+        for climate_slot in day:
+            climate_ref = climate_slot[0]
+            if len(climate_slot[2]) > 1:
+                if len(day) == 1:
+                    last_time = climate_slot[2]
+                    end_time = '23:30'
+                else:
+                    end_time = climate_slot[2]
+            else:
+                end_time = '23:30'
+            slot_time_start, slot_time_end = legacy_get_time_slot(last_time, end_time)
+            if slot_time_end == 47:
+                slot_time_end += 1
+            for slot in range(slot_time_start, slot_time_end):
+                schedule[idx][slot] = climate_ref
+            last_time = end_time
+    return schedule
+
+
+def compiled_set_schedule(schedule, program):
+    current = weekschedule.WeekSchedule.from_ecobee(schedule, 'sleep')
+    week = current.copy()
+    for idx, day in enumerate(program):
+        if len(day) > 0:
+            week.apply_program_day(idx, day)
+    for idx in week.changed_days(current):
+        schedule[idx] = week.day_to_ecobee(idx)
+    return schedule
+
+
+def bench(name, days, number=2000):
+    program = get_program(days)
+    assert legacy_set_schedule(get_current_schedule(), program) == \
+        compiled_set_schedule(get_current_schedule(), program)
+
+    legacy = min(timeit.repeat(lambda: legacy_set_schedule(get_current_schedule(), program),
+                               number=number, repeat=5)) / number * 1e6
+    compiled = min(timeit.repeat(lambda: compiled_set_schedule(get_current_schedule(), program),
+                                 number=number, repeat=5)) / number * 1e6
+    print(f'{name:<28} legacy {legacy:8.1f} us   compiled {compiled:8.1f} us   speedup {legacy / compiled:5.1f}x')
+
+
+def bench_time_slot(number=100000):
+    legacy = min(timeit.repeat(lambda: legacy_get_time_slot('12:30', '16:00'), number=number, repeat=5))
+    compiled = min(timeit.repeat(lambda: (weekschedule.get_slot('12:30'), weekschedule.get_slot('16:00')),
+                                 number=number, repeat=5))
+    print(f'{"time slot lookup":<28} legacy {legacy / number * 1e6:8.2f} us   compiled '
+          f'{compiled / number * 1e6:8.2f} us   speedup {legacy / compiled:5.1f}x')
+
+
+if __name__ == '__main__':
+    bench_time_slot()
+    bench('schedule, 1 day', [2])
+    bench('schedule, weekdays', [0, 1, 2, 3, 4])
+    bench('schedule, 7 days', list(range(7)))
@@ -1,6 +1,17 @@
 # -*- coding: utf-8 -*-
 
-try:
-    from ecobee.core import *  # NOQA
-except ImportError:
-    pass
\ No newline at end of file
+import importlib
+
+# Names re-exported from ecobee.core, loaded on first access so importing a submodule (or the package) doesn't
+# pull in pyecobee and requests
+_CORE_NAMES = ['Ecobee', 'authenticate', 'authorize', 'refresh_tokens', 'request_tokens']
+
+
+def __getattr__(name):
+    if name in _CORE_NAMES:
+        return getattr(importlib.import_module('ecobee.core'), name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(list(globals()) + _CORE_NAMES)
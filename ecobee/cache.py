@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+import copy
+import shelve
+import threading
+import time
+from ecobee import helpers, logger
+
+CACHE_FILE = f'{helpers.get_script_dir()}/pyecobee_cache'
+CACHE_LOCK = threading.Lock()  # shelve does not support concurrent access, serialize it between threads
+_memory = {}  # Snapshots already loaded or written by this process, long-running processes skip the file
+
+
+def _load(key, file_name):
+    if (file_name, key) in _memory:
+        # Copy so local (uncommitted) edits to the returned value never leak into the cache
+        return copy.deepcopy(_memory[(file_name, key)])
+
+    try:
+        with CACHE_LOCK, shelve.open(file_name, protocol=2) as pyecobee_cache:
+            value = pyecobee_cache.get(key)
+        _memory[(file_name, key)] = copy.deepcopy(value)
+        return value
+    except Exception as e:
+        # The cache is disposable, treat any read error as a cache miss
+        logger.warning(f'Unable to read cache ({key}), error: {e}')
+        return None
+
+
+def _store(key, value, file_name):
+    _memory[(file_name, key)] = copy.deepcopy(value)
+    try:
+        with CACHE_LOCK, shelve.open(file_name, protocol=2) as pyecobee_cache:
+            pyecobee_cache[key] = value
+    except Exception as e:
+        logger.warning(f'Unable to write cache ({key}), error: {e}')
+    return value
+
+
+def load_snapshot(identifier, file_name=CACHE_FILE):
+    # Returns the cached snapshot dict for a thermostat identifier, None when missing or unreadable
+    return _load(f'snapshot:{identifier}', file_name)
+
+
+def persist_snapshot(thermostat, weather_updated=None, file_name=CACHE_FILE):
+    logger.debug(f'Snapshot cache file: {file_name}')
+    snapshot = {'thermostat': thermostat,
+                'weather_updated': weather_updated if weather_updated is not None else time.time()}
+    return _store(f'snapshot:{thermostat.identifier}', snapshot, file_name)
+
+
+def load_plan(identifier, file_name=CACHE_FILE):
+    # Returns the last plan applied to a thermostat ({'key', 'program', 'schedule'}), None when missing
+    return _load(f'plan:{identifier}', file_name)
+
+
+def persist_plan(identifier, plan_key, program_fingerprint, file_name=CACHE_FILE):
+    plan = {'key': plan_key, 'program': program_fingerprint.digest, 'schedule': program_fingerprint.schedule}
+    return _store(f'plan:{identifier}', plan, file_name)
+
+
+def load_vacations(identifier, file_name=CACHE_FILE):
+    # Names of the off-peak vacations created on a thermostat by this tool, the only vacations it deletes
+    return set(_load(f'vacations:{identifier}', file_name) or ())
+
+
+def persist_vacations(identifier, names, file_name=CACHE_FILE):
+    return _store(f'vacations:{identifier}', sorted(names), file_name)
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import threading
+import requests
+import pyecobee.service
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from ecobee import logger
+
+DEFAULT_TIMEOUT = 30  # Seconds allowed for a single API call
+DEFAULT_MAX_CONNECTIONS = 4  # Keep-alive connections (and concurrent calls) per account
+
+_local = threading.local()
+_clients = {}
+_clients_lock = threading.Lock()
+_pooled_requests = None
+_pooled_requests_lock = threading.Lock()
+
+
+def _session():
+    return getattr(_local, 'session', None) or requests
+
+
+class _PooledRequests(object):
+    # Stands in for the requests module inside pyecobee.service so pyecobee calls made by a client
+    # are sent through that client's pooled session, anything else falls back to plain requests.
+    def __getattr__(self, name):
+        return getattr(requests, name)
+
+    @staticmethod
+    def get(url, **kwargs):
+        return _session().get(url, **kwargs)
+
+    @staticmethod
+    def post(url, **kwargs):
+        return _session().post(url, **kwargs)
+
+
+def install_pooled_requests():
+    # Replaces the requests module used by pyecobee.service when the first client is created (not at import).
+    # Fails loudly when pyecobee no longer uses requests that way, rather than silently sending without the pool.
+    global _pooled_requests
+    with _pooled_requests_lock:
+        if _pooled_requests is not None and pyecobee.service.requests is _pooled_requests:
+            return
+        target = getattr(pyecobee.service, 'requests', None)
+        if target is not requests:
+            raise RuntimeError(f'Unable to pool ecobee connections, pyecobee.service.requests is {target!r} instead of '
+                               f'the requests module. Is this pyecobee version supported?')
+        _pooled_requests = pyecobee.service.requests = _PooledRequests()
+
+
+def get_client(ecobee_service):
+    # One client (and connection pool) per account, keyed like the token store by thermostat name
+    with _clients_lock:
+        client = _clients.get(ecobee_service.thermostat_name)
+        if client is None:
+            client = _clients[ecobee_service.thermostat_name] = EcobeeClient(ecobee_service)
+        else:
+            client.ecobee_service = ecobee_service
+        return client
+
+
+class AsyncEcobeeClient(object):
+    def __init__(self, ecobee_service, max_connections=DEFAULT_MAX_CONNECTIONS, timeout=DEFAULT_TIMEOUT):
+        """
+        asyncio facade over pyecobee's blocking EcobeeService, calls share a keep-alive connection pool
+        """
+        install_pooled_requests()
+        self.ecobee_service = ecobee_service
+        self.timeout = timeout
+        self._session = requests.Session()
+        self._session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=max_connections))
+        self._executor = ThreadPoolExecutor(max_workers=max_connections,
+                                            thread_name_prefix=f'ecobee-{ecobee_service.thermostat_name}')
+
+    def _call(self, method_name, *args, **kwargs):
+        _local.session = self._session
+        try:
+            return getattr(self.ecobee_service, method_name)(*args, **kwargs)
+        finally:
+            _local.session = None
+
+    async def call(self, method_name, *args, timeout=None, **kwargs):
+        # Run an EcobeeService method on the pool, cancelled after timeout seconds. The timeout is also
+        # passed to requests so the worker thread gives up on the connection at the same time.
+        if timeout is None:
+            timeout = self.timeout
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._executor, lambda: self._call(method_name, *args, timeout=timeout,
+                                                                         **kwargs))
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            logger.error(f'ecobee API call {method_name} timed out after {timeout} seconds.')
+            raise
+
+    async def request_thermostats_summary(self, selection, timeout=None):
+        return await self.call('request_thermostats_summary', selection, timeout=timeout)
+
+    async def request_thermostats(self, selection, timeout=None):
+        return await self.call('request_thermostats', selection, timeout=timeout)
+
+    async def update_thermostats(self, selection, thermostat=None, functions=None, timeout=None):
+        return await self.call('update_thermostats', selection, thermostat=thermostat, functions=functions,
+                               timeout=timeout)
+
+    async def create_vacation(self, timeout=None, **kwargs):
+        return await self.call('create_vacation', timeout=timeout, **kwargs)
+
+    async def delete_vacation(self, name, timeout=None):
+        return await self.call('delete_vacation', name=name, timeout=timeout)
+
+    async def refresh_tokens(self, timeout=None):
+        return await self.call('refresh_tokens', timeout=timeout)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self._session.close()
+
+
+class EcobeeClient(object):
+    def __init__(self, ecobee_service, max_connections=DEFAULT_MAX_CONNECTIONS, timeout=DEFAULT_TIMEOUT):
+        """
+        Synchronous wrapper over AsyncEcobeeClient with the same methods as EcobeeService
+        """
+        self.aio = AsyncEcobeeClient(ecobee_service, max_connections=max_connections, timeout=timeout)
+
+    @property
+    def ecobee_service(self):
+        return self.aio.ecobee_service
+
+    @ecobee_service.setter
+    def ecobee_service(self, e_service):
+        self.aio.ecobee_service = e_service
+
+    @staticmethod
+    def run(coroutine):
+        return asyncio.run(coroutine)
+
+    def gather(self, *coroutines):
+        # Run independent calls (e.g. client.aio.request_thermostats(...)) concurrently, results in order
+        async def _gather():
+            return await asyncio.gather(*coroutines)
+        return self.run(_gather())
+
+    def request_thermostats_summary(self, selection, timeout=None):
+        return self.run(self.aio.request_thermostats_summary(selection, timeout=timeout))
+
+    def request_thermostats(self, selection, timeout=None):
+        return self.run(self.aio.request_thermostats(selection, timeout=timeout))
+
+    def update_thermostats(self, selection, thermostat=None, functions=None, timeout=None):
+        return self.run(self.aio.update_thermostats(selection, thermostat=thermostat, functions=functions,
+                                                    timeout=timeout))
+
+    def create_vacation(self, timeout=None, **kwargs):
+        return self.run(self.aio.create_vacation(timeout=timeout, **kwargs))
+
+    def delete_vacation(self, name, timeout=None):
+        return self.run(self.aio.delete_vacation(name, timeout=timeout))
+
+    def refresh_tokens(self, timeout=None):
+        return self.run(self.aio.refresh_tokens(timeout=timeout))
+
+    def close(self):
+        self.aio.close()
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+
+import copy
+import hashlib
+import importlib
+import importlib.util
+import os
+import threading
+import types
+from collections import namedtuple
+from ecobee import helpers, logger, supercool, weekschedule
+
+# Settings every configuration needs, the rest are optional and read with a default where they're used
+REQUIRED_SETTINGS = ['thermostat_name', 'climates', 'supercool_values', 'days_to_set', 'timeofuse_day_range',
+                     'timeofuse_restricted', 'timeofuse_holidays', 'timeofuse_holidays_cool_temp',
+                     'timeofuse_holidays_start_time', 'timeofuse_holidays_end_time', 'supercool_low_temp_cutoff',
+                     'supercool_month_range', 'notifications_enabled']
+
+# Notification channel -> (enabled setting, settings prefix, settings required when enabled), in sending order
+CHANNEL_SETTINGS = {'Email': ('email_enabled', 'email_', ['email_from', 'email_to', 'email_smtp_server',
+                                                         'email_smtp_port']),
+                    'PushBullet': ('pushbullet_enabled', 'pushbullet_', ['pushbullet_apikey']),
+                    'Pushover': ('pushover_enabled', 'pushover_', ['pushover_keys', 'pushover_apitoken']),
+                    'Join': ('join_enabled', 'join_', ['join_apikey'])}
+
+DAY_GROUPS = {'weekdays': [0, 1, 2, 3, 4], 'weekend': [5, 6]}
+
+Channel = namedtuple('Channel', ['name', 'options'])
+
+_settings = None
+_loaded = {}  # absolute settings file name -> Config, reused until the file's contents change
+_loaded_lock = threading.Lock()
+
+
+def get_values(settings):
+    # Public setting values of a settings module, namespace, dict or Config
+    if isinstance(settings, Config):
+        return dict(settings.values)
+    if isinstance(settings, dict):
+        return dict(settings)
+    values = {}
+    for name in dir(settings):
+        value = getattr(settings, name)
+        if not name.startswith('_') and not callable(value) and not isinstance(value, types.ModuleType):
+            values[name] = value
+    return values
+
+
+def get_hash(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def parse_range(name, value, low, high):
+    # "low-high" setting within low and high (inclusive), returned as a (low, high) tuple
+    try:
+        range_low, range_high = helpers.get_range_from_string(value)
+    except (AttributeError, ValueError):
+        raise ValueError(f'{name} "{value}" is not a "low-high" range.')
+    if not low <= range_low <= range_high <= high:
+        raise ValueError(f'{name} "{value}" must be a range between {low} and {high}.')
+    return range_low, range_high
+
+
+def parse_slot_time(name, value):
+    slot = weekschedule.get_slot(value)
+    if slot is None:
+        raise ValueError(f'{name} "{value}" is not a "HH:MM" time on a half hour.')
+    return slot
+
+
+class Config(object):
+    def __init__(self, settings, file_name=None, file_hash=None):
+        """
+        Settings parsed and validated once, read-only. Anything not compiled is read from the setting values.
+        """
+        values = copy.deepcopy(get_values(settings))
+        missing = [name for name in REQUIRED_SETTINGS if name not in values]
+        if missing:
+            raise ValueError(f'Missing settings: {", ".join(missing)}.')
+
+        compiled = {'values': types.MappingProxyType(values),
+                    'file_name': file_name,
+                    'file_hash': file_hash if file_hash is not None else get_hash(repr(sorted(values.items()))
+                                                                                  .encode('utf-8')),
+                    '_derived': {},
+                    '_derived_lock': threading.Lock()}
+        compiled['climate_prefixes'] = tuple(prefix.strip() for prefix in values['climates'].split(','))
+        compiled['supercool_bands'] = supercool.get_bands(values['supercool_values'],
+                                                          slot_count=len(compiled['climate_prefixes']))
+        low, high = parse_range('timeofuse_day_range', values['timeofuse_day_range'], 0, 6)
+        compiled['timeofuse_days'] = tuple(range(low, high + 1))
+        compiled['supercool_months'] = parse_range('supercool_month_range', values['supercool_month_range'], 1, 12)
+        compiled['lookahead'], compiled['sets_tomorrow'], compiled['fixed_days'] = \
+            self.parse_days_to_set(values['days_to_set'])
+        compiled['holidays'] = self.parse_holidays(values['timeofuse_holidays'])
+        compiled['holiday_slots'] = (parse_slot_time('timeofuse_holidays_start_time',
+                                                      values['timeofuse_holidays_start_time']),
+                                      parse_slot_time('timeofuse_holidays_end_time',
+                                                      values['timeofuse_holidays_end_time']))
+        compiled['notification_channels'] = self.parse_channels(values)
+        compiled['run_times'] = self.parse_run_times(values.get('daemon_run_times'))
+        for name, value in compiled.items():
+            object.__setattr__(self, name, value)
+
+        self.validate()
+
+    @staticmethod
+    def parse_days_to_set(value):
+        # Returns (lookahead, tomorrow, fixed days), fixed days are the named or numbered days that don't depend on
+        # the thermostat's date
+        if value.strip().lower() == 'lookahead':
+            return True, False, ()
+        tomorrow = False
+        fixed_days = set()
+        for day in value.split(','):
+            day = day.strip().lower()
+            if day == 'tomorrow':
+                tomorrow = True
+            elif day in DAY_GROUPS:
+                fixed_days.update(DAY_GROUPS[day])
+            else:
+                daynum = helpers.get_day_number(day)
+                if daynum is None:
+                    raise ValueError(f'days_to_set "{day}" is not a day name, number (0-6), weekdays, weekend, '
+                                     f'tomorrow or lookahead.')
+                fixed_days.add(daynum)
+        return False, tomorrow, tuple(sorted(fixed_days))
+
+    @staticmethod
+    def parse_holidays(value):
+        holidays = []
+        for holiday in value.split(','):
+            holiday = holiday.strip()
+            if not holiday:
+                continue
+            holiday_date = helpers.parse_date(holiday)
+            if holiday_date is None:
+                raise ValueError(f'timeofuse_holidays "{holiday}" is not a YYYY-MM-DD date.')
+            if holiday_date.date() not in holidays:
+                holidays.append(holiday_date.date())
+        return tuple(holidays)
+
+    @staticmethod
+    def parse_channels(values):
+        channels = []
+        for name, (enabled_setting, prefix, required) in CHANNEL_SETTINGS.items():
+            if not values.get(enabled_setting):
+                continue
+            missing = [setting for setting in required if not values.get(setting)]
+            if missing:
+                raise ValueError(f'{name} notifications are enabled but {", ".join(missing)} is not set.')
+            options = {setting[len(prefix):]: value for setting, value in values.items()
+                       if setting.startswith(prefix) and setting != enabled_setting}
+            channels.append(Channel(name, types.MappingProxyType(options)))
+        return tuple(channels)
+
+    @staticmethod
+    def parse_run_times(value):
+        # daemon_run_times as (hour, minute) tuples
+        if value is None:
+            return ()
+        run_times = []
+        for run_time in value.split(','):
+            try:
+                hour, minute = [int(x) for x in run_time.strip().split(':')]
+            except ValueError:
+                raise ValueError(f'daemon_run_times "{run_time.strip()}" is not a "HH:MM" time.')
+            if not (0 <= hour <= 23 and 0 <= minute <= 59):
+                raise ValueError(f'daemon_run_times "{run_time.strip()}" is not a "HH:MM" time.')
+            run_times.append((hour, minute))
+        return tuple(run_times)
+
+    def validate(self):
+        # Checks across settings, each setting on its own was validated when it was parsed
+        start_slot, end_slot = self.holiday_slots
+        if end_slot < start_slot:
+            raise ValueError(f'timeofuse_holidays_end_time {self.timeofuse_holidays_end_time} is before '
+                             f'timeofuse_holidays_start_time {self.timeofuse_holidays_start_time}.')
+
+        if self.timeofuse_restricted and not self.lookahead and not self.sets_tomorrow and \
+                not set(self.fixed_days) & set(self.timeofuse_days):
+            raise ValueError(f'timeofuse_restricted is set and none of the days_to_set "{self.days_to_set}" are in '
+                             f'timeofuse_day_range "{self.timeofuse_day_range}".')
+
+        cutoff = self.supercool_low_temp_cutoff
+        self.supercool_bands.check_cutoff(cutoff)
+        if len(self.supercool_bands) and cutoff > self.supercool_bands.high:
+            logger.warning(f'supercool_low_temp_cutoff {cutoff} is above every supercool temperature band, no '
+                           f'program will be set.')
+
+        if self.notifications_enabled and not self.notification_channels:
+            logger.warning('notifications_enabled is set but no notification channel is enabled.')
+
+    def derive(self, overrides):
+        # Config with some settings overridden (a fleet entry), compiled once per set of overrides
+        key = repr(sorted(overrides.items()))
+        with self._derived_lock:
+            derived = self._derived.get(key)
+            if derived is None:
+                derived = self._derived[key] = Config({**self.values, **overrides}, file_name=self.file_name)
+            return derived
+
+    def __getattr__(self, name):
+        # Only called for names that weren't compiled
+        try:
+            return self.values[name]
+        except KeyError:
+            raise AttributeError(f'Setting "{name}" is not configured.')
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Config is read-only, edit the settings file instead.')
+
+    def __delattr__(self, name):
+        raise AttributeError('Config is read-only, edit the settings file instead.')
+
+
+def get_config(settings):
+    # Compile a settings module (or namespace, dict), an already compiled Config is returned as is
+    return settings if isinstance(settings, Config) else Config(settings)
+
+
+def get_settings_file():
+    spec = importlib.util.find_spec('local_settings')
+    if spec is None or spec.origin is None:
+        raise ImportError('No local_settings.py found, create one from sample_local_settings.py.')
+    return spec.origin
+
+
+def load(file_name=None):
+    # Compile a settings file (local_settings.py by default). The compiled Config is reused while the file's
+    # contents are unchanged, so reloading (daemon SIGHUP) is cheap.
+    file_name = os.path.abspath(file_name if file_name is not None else get_settings_file())
+    with open(file_name, 'rb') as settings_file:
+        file_hash = get_hash(settings_file.read())
+
+    with _loaded_lock:
+        loaded = _loaded.get(file_name)
+    if loaded is not None and loaded.file_hash == file_hash:
+        return loaded
+
+    spec = importlib.util.spec_from_file_location('local_settings', file_name)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    loaded = Config(module, file_name=file_name, file_hash=file_hash)
+    with _loaded_lock:
+        _loaded[file_name] = loaded
+    return loaded
+
+
+def configure(settings):
+    # Entry points pass in their settings (compiled here if needed), nothing is read at import time
+    global _settings
+    _settings = get_config(settings)
+    return _settings
+
+
+def get_settings():
+    # Callers that never configured settings get local_settings, imported and compiled on first use
+    global _settings
+    if _settings is None:
+        _settings = Config(importlib.import_module('local_settings'))
+    return _settings
@@ -1,30 +1,15 @@
 # -*- coding: utf-8 -*-
 
-import shelve
 import pytz
 import time
-from six.moves import input
 from pyecobee import *
 from datetime import datetime, timedelta
-from ecobee import helpers, logger
+from ecobee import cache, client, config, fingerprint, forecast, helpers, logger, supercool, tokens, weekschedule
 from pytz import timezone
 
-DB_FILE = f'{helpers.get_script_dir()}/pyecobee_db'
-
-
-def persist_to_shelf(ecobee_service, file_name=DB_FILE):
-    logger.debug(f'Shelve file: {file_name}')
-    pyecobee_db = shelve.open(file_name, protocol=2)
-    pyecobee_db[ecobee_service.thermostat_name] = ecobee_service
-    pyecobee_db.close()
-
 
 def refresh_tokens(ecobee_service):
-    token_response = ecobee_service.refresh_tokens()
-    logger.debug('TokenResponse returned from ecobee_service.refresh_tokens():\n{0}'.format(
-        token_response.pretty_format()))
-
-    persist_to_shelf(ecobee_service)
+    tokens.refresh(ecobee_service, force=True)
 
 
 def request_tokens(ecobee_service):
@@ -32,7 +17,7 @@ def request_tokens(ecobee_service):
     logger.debug('TokenResponse returned from ecobee_service.request_tokens():\n{0}'.format(
         token_response.pretty_format()))
 
-    persist_to_shelf(ecobee_service)
+    tokens.save(ecobee_service)
 
 
 def authorize(ecobee_service):
@@ -40,7 +25,7 @@ def authorize(ecobee_service):
     logger.debug('AuthorizeResponse returned from ecobee_service.authorize():\n{0}'.format(
         authorize_response.pretty_format()))
 
-    persist_to_shelf(ecobee_service)
+    tokens.save(ecobee_service)
 
     logger.info('Please goto ecobee.com, login to the web portal and click on the settings tab. Ensure the My '
                 'Apps widget is enabled. If it is not click on the My Apps option in the menu on the left. In the '
@@ -51,24 +36,20 @@ def authorize(ecobee_service):
     input()
 
 
-def authenticate(thermostat_name, db_file=None):
-    pyecobee_db = ecobee_service = None
-    if db_file is None:
-        db_file = DB_FILE
-    try:
-        pyecobee_db = shelve.open(db_file, protocol=2)
-        ecobee_service = pyecobee_db[thermostat_name]
-    except KeyError:
-        application_key = input('Please enter the API key of your ecobee App: ')
-        ecobee_service = EcobeeService(thermostat_name=thermostat_name, application_key=application_key)
-    finally:
-        try:
-            pyecobee_db.close()
-        except Exception as e:
-            logger.error(f'Error closing shelf DB, error: {e}')
+def authenticate(thermostat_name, db_file=None, token_file=None, refresher=True):
+    # Load the account's tokens from the token store, authorizing interactively the first time. Tokens are
+    # refreshed by a background thread before they expire, only an already expired token is refreshed here.
+    # db_file is deprecated, it's only read to import the tokens of an older version into the token store.
+    if token_file is None:
+        token_file = tokens.TOKEN_FILE
+    if db_file is not None:
+        logger.warning(f'authenticate() db_file is deprecated, tokens are kept in {token_file}. {db_file} is only '
+                       f'read to import tokens missing from it.')
 
+    ecobee_service = tokens.load(thermostat_name, file_name=token_file, legacy_db_file=db_file)
     if ecobee_service is None:
-        return
+        application_key = input('Please enter the API key of your ecobee App: ')
+        ecobee_service = EcobeeService(thermostat_name=thermostat_name, application_key=application_key)
 
     if ecobee_service.authorization_token is None:
         authorize(ecobee_service)
@@ -83,11 +64,10 @@ def authenticate(thermostat_name, db_file=None):
         request_tokens(ecobee_service)
     elif now_utc > ecobee_service.access_token_expires_on:
         logger.info('Access token expired, attempting to refresh the token.')
-        refresh_tokens(ecobee_service)
-    elif now_utc + timedelta(minutes=1) > ecobee_service.access_token_expires_on:
-        logger.info('Access token expires within the next minute, attempting to refresh the token.')
-        refresh_tokens(ecobee_service)
+        tokens.refresh(ecobee_service, margin=timedelta(0), file_name=token_file)
 
+    if refresher:
+        tokens.start_refresher(ecobee_service, file_name=token_file)
     return ecobee_service
 
 
@@ -100,7 +80,25 @@ class Ecobee:
                                   include_location=True,
                                   include_events=True,
                                   include_settings=True)
+    SUMMARY_SELECTION = Selection(selection_type=SelectionType.REGISTERED.value,
+                                  selection_match='')
     DEFAULT_CLIMATE = "sleep"
+    UPDATE_TIMEOUT = 60  # Max seconds to wait for ecobee to process a write
+    UPDATE_POLL_INTERVAL = 0.5  # Initial delay between revision polls, doubles up to UPDATE_POLL_MAX_INTERVAL
+    UPDATE_POLL_MAX_INTERVAL = 5
+    # Named selection profiles, each fetch only includes the parts of the thermostat that are needed
+    SELECTION_PROFILES = {
+        'full': ['program', 'weather', 'sensors', 'location', 'events', 'settings'],
+        'program': ['program'],
+        'events': ['events'],
+        'weather': ['weather'],
+        'settings': ['settings'],
+    }
+    # Snapshot cache: parts of the thermostat refreshed when the thermostat revision changes, weather has no
+    # revision so it is refreshed once the cached copy is older than WEATHER_MAX_AGE seconds
+    REVISION_PARTS = ['program', 'events', 'settings', 'location', 'sensors']
+    WEATHER_MAX_AGE = 3600
+    CLIMATE_CREATE_MAX_ATTEMPTS = 50  # Max update_thermostats calls used to create missing climates
 
     def __init__(
             self,
@@ -129,50 +127,47 @@ class Ecobee:
             supercool_cutoff=None,
             supercool_values=None,
             hvac_mode=None,
-            supercool_months=None
+            supercool_months=None,
+            update_timeout=None,
+            cache_file=None,
+            notification_channels=None
     ):
         """
-        Construct an Ecobee thermostat instance
+        Construct an Ecobee thermostat instance, the thermostat snapshot is only fetched (and parsed) when first used
         """
-        if supercool_values is None:
-            supercool_values = {}
         self._ecobee_service = ecobee_service
+        self._client = client.get_client(ecobee_service)
+        self.update_timeout = update_timeout if update_timeout is not None else self.UPDATE_TIMEOUT
         self._selection = selection if selection is not None else self.DEFAULT_SELECTION
-        if thermostat_list is not None:
-            self._thermostat_list = thermostat_list
-        else:
-            self.thermostat_list = self.selection
-        self._thermostat_name = thermostat_name if thermostat_name is not None else self.get_thermostat_name()
-        self._thermostat_index = thermostat_index if thermostat_index is not None else \
-            self.get_thermostat_index(name=self._thermostat_name)
-        self._thermostat_identifier = thermostat_identifier if thermostat_identifier is not None else \
-            self.get_thermostat_identifier(name=self._thermostat_name, index=self._thermostat_index)
-        self._thermostat_object = thermostat_object if thermostat_object is not None else self.thermostat_object
-        self._thermostat_climates = thermostat_climates if thermostat_climates is not None else \
-            self.thermostat_climates
-        self._thermostat_schedule = thermostat_schedule if thermostat_schedule is not None else \
-            self.thermostat_schedule
-        self._temp_high = temp_high if temp_high is not None else self.get_forecast_temp_high()
-        if self._temp_high == 9999:
-            logger.error('Unknown high temperature, unable to make program changes.')
-        self._thermostat_events = thermostat_events if thermostat_events is not None else self.thermostat_events
-        self._thermostat_settings = thermostat_settings if thermostat_settings is not None else \
-            self.thermostat_settings
-        self._high_temp_list = high_temp_list if high_temp_list is not None else self.get_forecast_high_temps()
+        self.cache_file = cache_file
+        # Thermostat identifier -> when its cached weather was fetched, kept when other parts are saved
+        self._weather_updated = {}
+        # config.Channel of the run, the configured settings' channels when None
+        self.notification_channels = notification_channels
+        self._program_staged = False
+        self._staged_vacations = {}
+        self._created_vacations = None
+        self._climate_name_index = helpers.ObjectIndex('name')
+        self._climate_ref_index = helpers.ObjectIndex('climate_ref')
+        self._event_index = helpers.ObjectIndex('name')
+        # Values derived from the snapshot (see helpers.snapshot_property), cleared by invalidate_snapshot()
+        self._snapshot = {}
+        self._thermostat_list = thermostat_list
+        self._thermostat_name = thermostat_name
+        self._thermostat_index = thermostat_index
+        self._thermostat_identifier = thermostat_identifier
+        # thermostat_object, thermostat_climates, thermostat_schedule, thermostat_events, thermostat_settings,
+        # tomorrow_daynum, thermostat_sensors, timezone, isdaylightsavings and hvac_mode always come from the snapshot
+        self._temp_high = temp_high
+        self._high_temp_list = high_temp_list
         self.new_climate_prefixes = new_climate_prefixes
         self.new_climate_names = new_climate_names
         self.timeofuse_days = timeofuse_days
         self.timeofuse_restricted = timeofuse_restricted
         self.days_to_set = days_to_set
-        self._tomorrow_daynum = tomorrow_daynum
-        self._thermostat_sensors = thermostat_sensors if thermostat_sensors is not None else self.thermostat_sensors
-        self._timezone = timezone if timezone is not None else self.timezone
-        self._isdaylightsavings = isdaylightsavings if isdaylightsavings is not None else self.isdaylightsavings
-        self._supercool_cutoff = supercool_cutoff if supercool_cutoff is not None else self.supercool_cutoff
-        self._supercool_values = supercool_values if supercool_values is not None else self.supercool_values
-        self._hvac_mode = hvac_mode if hvac_mode is not None else self.hvac_mode
-        self._during_supercool_months = self.during_supercool_months = supercool_months \
-            if supercool_months is not None else self.during_supercool_months
+        self._supercool_cutoff = supercool_cutoff
+        self.supercool_values = supercool_values if supercool_values is not None else {}
+        self.during_supercool_months = supercool_months
 
     @property
     def ecobee_service(self):
@@ -185,54 +180,72 @@ class Ecobee:
     @ecobee_service.setter
     def ecobee_service(self, e_service):
         self._ecobee_service = e_service
+        self._client = client.get_client(e_service)
 
     @property
     def thermostat_list(self):
+        # Fetched on first use, from the snapshot cache when there is one
+        if self._thermostat_list is None:
+            self._thermostat_list = self.get_cached_thermostats() if self.cache_file is not None else \
+                self.get_thermostats(self.selection)
         return self._thermostat_list
 
     @thermostat_list.setter
     def thermostat_list(self, selection):
         self._thermostat_list = self.get_thermostats(selection)
+        self.invalidate_snapshot()
 
-    @property
+    def invalidate_snapshot(self):
+        # Everything derived from the snapshot is recomputed on next use
+        self._snapshot.clear()
+
+    @helpers.snapshot_property
     def thermostat_index(self):
-        return self._thermostat_index
+        if self._thermostat_index is not None:
+            return self._thermostat_index
+        if self._thermostat_name is not None:
+            return self.get_thermostat_index(name=self._thermostat_name)
+        return self.get_thermostat_index(identifier=self._thermostat_identifier)
 
     @property
     def thermostat_name(self):
-        return self._thermostat_name
+        return self._thermostat_name if self._thermostat_name is not None else self.thermostat_object.name
 
     @property
     def thermostat_identifier(self):
-        return self._thermostat_identifier
+        return self._thermostat_identifier if self._thermostat_identifier is not None else \
+            self.thermostat_object.identifier
 
-    @property
+    @helpers.snapshot_property
     def thermostat_object(self):
-        return self._thermostat_list[self.thermostat_index]
+        return self.thermostat_list[self.thermostat_index]
 
     @property
     def thermostat_climates(self):
-        return self._thermostat_list[self.thermostat_index].program.climates
+        return self.thermostat_object.program.climates
 
     @property
     def thermostat_schedule(self):
-        return self._thermostat_list[self.thermostat_index].program.schedule
+        return self.thermostat_object.program.schedule
 
     @property
     def thermostat_events(self):
-        return self._thermostat_list[self.thermostat_index].events
+        return self.thermostat_object.events
 
     @property
     def thermostat_settings(self):
-        return self._thermostat_list[self.thermostat_index].settings
+        return self.thermostat_object.settings
 
-    @property
+    @helpers.snapshot_property
     def temp_high(self):
-        return self._temp_high
+        temp_high = self._temp_high if self._temp_high is not None else self.get_forecast_temp_high()
+        if temp_high == forecast.UNKNOWN_TEMP:
+            logger.error('Unknown high temperature, unable to make program changes.')
+        return temp_high
 
-    @property
+    @helpers.snapshot_property
     def high_temp_list(self):
-        return self._high_temp_list
+        return self._high_temp_list if self._high_temp_list is not None else self.get_forecast_high_temps()
 
     @property
     def new_climate_prefixes(self):
@@ -256,8 +269,12 @@ class Ecobee:
 
     @timeofuse_days.setter
     def timeofuse_days(self, value):
-        self._timeofuse_days = list(range(int(value.split('-')[0]), int(value.split('-')[1]) + 1)) \
-            if value is not None else list()
+        # A "low-high" range or the already parsed days (config.Config.timeofuse_days)
+        if isinstance(value, str):
+            low, high = helpers.get_range_from_string(value)
+            value = range(low, high + 1)
+        self._timeofuse_days = list(value) if value is not None else list()
+        self._snapshot.pop('days_to_set', None)
 
     @property
     def timeofuse_restricted(self):
@@ -266,31 +283,50 @@ class Ecobee:
     @timeofuse_restricted.setter
     def timeofuse_restricted(self, value):
         self._timeofuse_restricted = value
+        self._snapshot.pop('days_to_set', None)
 
-    @property
+    @helpers.snapshot_property
     def days_to_set(self):
-        return self._days_to_set
+        if self.lookahead:
+            return self.get_lookahead_days()
+        day_set = set(self._fixed_days)
+        if self._sets_tomorrow:
+            # "tomorrow" is relative to the thermostat's date, not the server's
+            day_set.add(self.tomorrow_daynum)
+        return sorted(day_set)
 
     @days_to_set.setter
     def days_to_set(self, value):
-        self._days_to_set = helpers.get_day_slots(days=value) if value is not None else list()
+        # A days_to_set string or the already parsed (lookahead, tomorrow, fixed days) of config.Config.
+        # "lookahead" sets every forecast day after today, each with its own high temp. Lookahead and tomorrow are
+        # resolved against the forecast on first use.
+        if isinstance(value, str):
+            value = config.Config.parse_days_to_set(value)
+        self.lookahead, self._sets_tomorrow, self._fixed_days = value if value is not None else (False, False, ())
+        self._snapshot.pop('days_to_set', None)
 
     @property
     def tomorrow_daynum(self):
-        return datetime.strptime(self._thermostat_list[self.thermostat_index].weather.forecasts[1].date_time,
-                                 '%Y-%m-%d %H:%M:%S').weekday()
+        return self.forecast_index.tomorrow.weekday()
+
+    @helpers.snapshot_property
+    def forecast_index(self):
+        # Parsed once per snapshot
+        weather = self.thermostat_object.weather
+        time_zone = self.thermostat_object.location.time_zone if self.thermostat_object.location else None
+        return forecast.ForecastIndex(weather.forecasts if weather else None, time_zone=time_zone)
 
     @property
     def thermostat_sensors(self):
-        return self._thermostat_list[self.thermostat_index].remote_sensors
+        return self.thermostat_object.remote_sensors
 
-    @property
+    @helpers.snapshot_property
     def timezone(self):
-        return self._thermostat_list[self.thermostat_index].location.time_zone
+        return self.thermostat_object.location.time_zone
 
-    @property
+    @helpers.snapshot_property
     def isdaylightsavings(self):
-        return self._thermostat_list[self.thermostat_index].location.is_daylight_saving
+        return self.thermostat_object.location.is_daylight_saving
 
     @property
     def supercool_cutoff(self):
@@ -304,24 +340,42 @@ class Ecobee:
     def supercool_values(self):
         return self._supercool_values
 
-    @property
+    @supercool_values.setter
+    def supercool_values(self, value):
+        # Compiled into a sorted band index, one slot per climate prefix
+        slot_count = len(self.new_climate_prefixes) if self.new_climate_prefixes else None
+        self._supercool_values = supercool.get_bands(value, slot_count=slot_count)
+        if self.supercool_cutoff is not None and not isinstance(value, supercool.SupercoolBands):
+            # Already compiled bands were checked against the cutoff with the rest of the config
+            self._supercool_values.check_cutoff(self.supercool_cutoff)
+
+    @helpers.snapshot_property
     def hvac_mode(self):
-        return self._thermostat_list[self.thermostat_index].settings.hvac_mode.lower()
+        return self.thermostat_settings.hvac_mode.lower()
 
     @property
     def during_supercool_months(self):
-        return self._during_supercool_months
+        # Checked against the current month on every use, a daemon keeps running across months
+        if self._supercool_months is None:
+            return False
+        return self._supercool_months[0] <= datetime.now().month <= self._supercool_months[1]
 
     @during_supercool_months.setter
     def during_supercool_months(self, value):
-        temp_list = helpers.get_range_from_string(value)
-        if temp_list[0] <= datetime.now().month <= temp_list[1]:
-            self._during_supercool_months = True
-        else:
-            self._during_supercool_months = False
+        # A "low-high" month range or the already parsed (low, high) months
+        self._supercool_months = helpers.get_range_from_string(value) if isinstance(value, str) else value
 
     def get_thermostats(self, selection):
-        thermostat_response = self._ecobee_service.request_thermostats(selection)
+        return self.get_thermostat_response_list(self._client.request_thermostats(selection))
+
+    def get_thermostats_concurrently(self, selections):
+        # Independent reads are sent at the same time over the account's connection pool
+        thermostat_responses = self._client.gather(*[self._client.aio.request_thermostats(selection)
+                                                     for selection in selections])
+        return [self.get_thermostat_response_list(thermostat_response) for thermostat_response in thermostat_responses]
+
+    @staticmethod
+    def get_thermostat_response_list(thermostat_response):
         if thermostat_response.status.code == 0:
             return thermostat_response.thermostat_list
         else:
@@ -329,71 +383,204 @@ class Ecobee:
 
     def get_thermostat_index(self, name=None, identifier=None):
         if name is not None:
-            return next((idx for idx, x in enumerate(self._thermostat_list) if x.name == name), 0)
+            return next((idx for idx, x in enumerate(self.thermostat_list) if x.name == name), 0)
         if identifier is not None:
-            return next((idx for idx, x in enumerate(self._thermostat_list) if x.identifier == identifier), 0)
+            return next((idx for idx, x in enumerate(self.thermostat_list) if x.identifier == identifier), 0)
 
         return 0
 
     def get_thermostat_name(self, index=None, identifier=None):
         if index is not None:
-            return self._thermostat_list[index].name
+            return self.thermostat_list[index].name
         if identifier is not None:
-            return next(x.name for x in self._thermostat_list if x.identifier == identifier)
+            return next(x.name for x in self.thermostat_list if x.identifier == identifier)
 
-        return self._thermostat_list[0].name  # Default return first name
+        return self.thermostat_list[0].name  # Default return first name
 
     def get_thermostat_identifier(self, name=None, index=None):
         if index is not None:
-            return self._thermostat_list[index].identifier
+            return self.thermostat_list[index].identifier
         if name is not None:
-            return next(x.identifier for x in self._thermostat_list if x.name == name)
-
-        return self._thermostat_list[0].identifier  # Default return first identifier
+            return next(x.identifier for x in self.thermostat_list if x.name == name)
+
+        return self.thermostat_list[0].identifier  # Default return first identifier
+
+    def get_revision_list(self):
+        summary_response = self._client.request_thermostats_summary(self.SUMMARY_SELECTION)
+        if summary_response.status.code != 0:
+            logger.error(f'Failure while executing request_thermostats_summary:\n'
+                         f'{summary_response.pretty_format()}')
+            return None
+
+        return [helpers.parse_revision(revision) for revision in summary_response.revision_list]
+
+    def get_thermostat_revisions(self):
+        revision_list = self.get_revision_list()
+        if revision_list is None:
+            return None
+
+        return next((revisions for revisions in revision_list
+                     if revisions['identifier'] == self.thermostat_identifier), None)
+
+    def get_partial_selection(self, identifier, parts):
+        return Selection(selection_type=SelectionType.THERMOSTATS.value,
+                         selection_match=identifier,
+                         **{f'include_{part}': True for part in parts})
+
+    def get_profile_selection(self, profile):
+        return self.get_partial_selection(self.thermostat_identifier, self.SELECTION_PROFILES[profile])
+
+    def refresh(self, *profiles):
+        # Fetch the parts of the thermostat in each selection profile (concurrently) and merge them
+        # into the current snapshot
+        if not profiles:
+            profiles = ('full',)
+        thermostat_responses = self.get_thermostats_concurrently([self.get_profile_selection(profile)
+                                                                  for profile in profiles])
+        for profile, thermostat_response in zip(profiles, thermostat_responses):
+            if not thermostat_response:
+                logger.error(f'Unable to refresh the thermostat ({profile}).')
+                return False
+            helpers.merge_ecobee_objects(self.thermostat_object, thermostat_response[0])
 
-    def get_forecast_high_temps(self):
-        high_temps = []
-        for i in range(7):
-            high_temps.append(None)
+        self.invalidate_snapshot()
+        fetched_weather = any('weather' in self.SELECTION_PROFILES[profile] for profile in profiles)
+        self.save_snapshot(weather_updated=time.time() if fetched_weather else None)
+        return True
 
-        weather_forecasts = self._thermostat_list[self.thermostat_index].weather.forecasts
-        for i in range(1, 5):
-            forecast_day_num = datetime.strptime(weather_forecasts[i].date_time, '%Y-%m-%d %H:%M:%S').weekday()
-            high_temps[forecast_day_num] = weather_forecasts[i].temp_high
+    def get_cached_thermostats(self):
+        # Use the on-disk snapshot for each thermostat and only fetch the parts that are stale
+        revision_list = self.get_revision_list()
+        if revision_list is None:
+            return self.get_thermostats(self.selection)
+
+        snapshots = []
+        stale = []
+        for revisions in revision_list:
+            identifier = revisions['identifier']
+            snapshot = cache.load_snapshot(identifier, file_name=self.cache_file)
+            if snapshot is None:
+                logger.debug(f'No cached snapshot for thermostat {identifier}, fetching all parts.')
+                parts = self.REVISION_PARTS + ['weather']
+            else:
+                self._weather_updated[identifier] = snapshot['weather_updated']
+                parts = []
+                if snapshot['thermostat'].thermostat_rev != revisions['thermostat']:
+                    parts.extend(self.REVISION_PARTS)
+                if time.time() - snapshot['weather_updated'] > self.WEATHER_MAX_AGE:
+                    parts.append('weather')
+
+            snapshots.append(snapshot)
+            if parts:
+                logger.info(f'Refreshing {", ".join(parts)} for thermostat {identifier}.')
+                stale.append((len(snapshots) - 1, parts))
+            else:
+                logger.info(f'Thermostat {identifier} unchanged since last run, using cached snapshot.')
+
+        # Fetch the stale thermostats concurrently
+        fetched_lists = self.get_thermostats_concurrently([
+            self.get_partial_selection(revision_list[idx]['identifier'], parts) for idx, parts in stale])
+        thermostat_list = [snapshot['thermostat'] if snapshot is not None else None for snapshot in snapshots]
+        for (idx, parts), fetched_list in zip(stale, fetched_lists):
+            if not fetched_list:
+                return self.get_thermostats(self.selection)
+
+            thermostat = fetched_list[0]
+            weather_updated = time.time()
+            if snapshots[idx] is not None:
+                thermostat = helpers.merge_ecobee_objects(snapshots[idx]['thermostat'], thermostat)
+                if 'weather' not in parts:
+                    weather_updated = snapshots[idx]['weather_updated']
+            self._weather_updated[thermostat.identifier] = weather_updated
+            cache.persist_snapshot(thermostat, weather_updated=weather_updated, file_name=self.cache_file)
+            thermostat_list[idx] = thermostat
+
+        return thermostat_list
+
+    def save_snapshot(self, weather_updated=None):
+        # weather_updated is only passed when the weather was just fetched, otherwise the cached weather keeps its
+        # age (unknown age counts as stale) so it's still refreshed once it's older than WEATHER_MAX_AGE
+        if self.cache_file is None:
+            return
+        identifier = self.thermostat_object.identifier
+        if weather_updated is None:
+            weather_updated = self._weather_updated.get(identifier, 0)
+        self._weather_updated[identifier] = weather_updated
+        cache.persist_snapshot(self.thermostat_object, weather_updated=weather_updated, file_name=self.cache_file)
+
+    def wait_for_update(self, thermostat_rev, timeout=None):
+        # Poll the lightweight thermostat summary until the thermostat revision moves past thermostat_rev,
+        # which means ecobee has processed the write. Returns the number of seconds waited.
+        if timeout is None:
+            timeout = self.update_timeout
+
+        start = time.monotonic()
+        delay = self.UPDATE_POLL_INTERVAL
+        while True:
+            time.sleep(delay)
+            waited = time.monotonic() - start
+            revisions = self.get_thermostat_revisions()
+            if revisions is not None and revisions['thermostat'] != thermostat_rev:
+                logger.info(f'Thermostat revision changed after {waited:.1f} seconds.')
+                return waited
+
+            if waited >= timeout:
+                logger.warning(f'Thermostat revision unchanged after {waited:.1f} seconds, continuing anyway.')
+                return waited
+
+            delay = min(delay * 2, self.UPDATE_POLL_MAX_INTERVAL, max(timeout - waited, self.UPDATE_POLL_INTERVAL))
+
+    def refresh_after_update(self, thermostat_rev, profile='full'):
+        # Wait for ecobee to process the request, then update the changed parts of the thermostat object
+        self.wait_for_update(thermostat_rev)
+        self.refresh(profile)
+
+    def send_notifications(self, title, message, severity='info'):
+        helpers.send_notifications(title, message, severity=severity, channels=self.notification_channels)
 
-        return high_temps
+    def get_forecast_high_temps(self):
+        return self.forecast_index.get_high_temps()
+
+    def get_lookahead_days(self):
+        # Forecast days after today in date order, only time of use days when restricted
+        days = [date.weekday() for date in sorted(self.forecast_index.by_date) if date > self.forecast_index.today]
+        if self.timeofuse_restricted:
+            days = [daynum for daynum in days if daynum in self.timeofuse_days]
+        return days
+
+    def get_day_temp_high(self, daynum):
+        # In lookahead mode each day uses its own forecast high, otherwise every day uses tomorrow's high
+        if self.lookahead:
+            temp_high = self.high_temp_list[daynum]
+            return temp_high if temp_high is not None else forecast.UNKNOWN_TEMP
+        return self.temp_high
 
     def get_forecast_temp_high(self, day='tomorrow'):
-        day_num = helpers.get_day_number(day)
-        weather_forecasts = self._thermostat_list[self.thermostat_index].weather.forecasts
-        for forecast in weather_forecasts:
-            forecast_day_num = datetime.strptime(forecast.date_time, '%Y-%m-%d %H:%M:%S').weekday()
-            if forecast_day_num == day_num:
-                return forecast.temp_high
+        # Ecobee provides 4 days of forecasts, if beyond 4 days this will return forecast.UNKNOWN_TEMP
+        if day.lower() == 'tomorrow':
+            return self.forecast_index.get_high(date=self.forecast_index.tomorrow)
+        return self.forecast_index.get_high(weekday=helpers.get_day_number(day, today=self.forecast_index.today))
 
-        return 9999  # Ecobee provides 4 days of forecasts, if beyond 4 days this will return 9999
+    def get_climate(self, name=None, climate_ref=None):
+        # Case-insensitive lookups, the indexes follow the snapshot as it's refreshed or climates are added
+        if name is not None:
+            return self._climate_name_index.get(self.thermostat_climates, name)
+        if climate_ref is not None:
+            return self._climate_ref_index.get(self.thermostat_climates, climate_ref)
 
     def get_climate_ref(self, name):
-        for climate in self.thermostat_climates:
-            if climate.name.lower() == name.lower():
-                return climate.climate_ref
+        climate = self.get_climate(name=name)
+        if climate is not None:
+            return climate.climate_ref
+
+    def get_event(self, name):
+        return self._event_index.get(self.thermostat_events, name)
 
     def event_exist(self, name):
-        for event in self.thermostat_events:
-            if event.name.lower() == name.lower():
-                return True
-        return False
+        return self.get_event(name) is not None
 
     def set_thermostat_schedule(self, program, update=False, notify=False):
         title = message = None
-        schedule = self.thermostat_schedule
-
-        # prefill nested list with default climateRef (sleep)
-        if schedule is None:
-            schedule = []
-            for i in range(7):
-                schedule.append([])
-                schedule[i].extend([self.DEFAULT_CLIMATE] * 48)
 
         # check if program is empty
         if not any(program):
@@ -401,34 +588,24 @@ class Ecobee:
             logger.info('No program updates, no changes made to the schedule.')
             return
 
+        # Compile the schedule (prefilled with the default climateRef if there is none) into a 7x48 array
+        # and only convert the days that changed back to the ecobee format
+        current = weekschedule.WeekSchedule.from_ecobee(self.thermostat_schedule, self.DEFAULT_CLIMATE)
+        week = current.copy()
         for idx, day in enumerate(program):
             if len(day) == 0:
                 continue
 
             logger.debug(f'Setting the schedule for {helpers.get_day_name(idx)}.')
+            week.apply_program_day(idx, day)
 
-            last_time = '00:00'
-            for climate_slot in day:
-                climate_ref = climate_slot[0]
-
-                # For setting prior nights sleep climate
-                if len(climate_slot[2]) > 1:
-                    if len(day) == 1:
-                        last_time = climate_slot[2]
-                        end_time = '23:30'
-                    else:
-                        end_time = climate_slot[2]
-                else:
-                    end_time = '23:30'
-                slot_time_start, slot_time_end = helpers.get_time_slot(last_time, end_time)
-                if slot_time_end == 47:
-                    # Adjust for last slot of the day
-                    slot_time_end += 1
-                # for day_slot in slot_days:
-                for slot in range(slot_time_start, slot_time_end):
-                    schedule[idx][slot] = climate_ref
-                    # temp_schedule[day_slot][slot] = climate
-                last_time = end_time
+        changed_days = week.changed_days(current)
+        logger.debug(f'Schedule changed for: {", ".join(helpers.get_day_name(idx) for idx in changed_days) or "none"}')
+        if self.thermostat_schedule is None:
+            self.thermostat_object.program.schedule = week.to_ecobee()
+        else:
+            for idx in changed_days:
+                self.thermostat_schedule[idx] = week.day_to_ecobee(idx)
 
         if update:
             logger.info('Attempting to update the thermostat schedule.')
@@ -450,7 +627,7 @@ class Ecobee:
                 logger.error(message)
 
             if notify and title is not None:
-                helpers.send_notifications(title, message)
+                self.send_notifications(title, message, severity='error' if return_value < 0 else 'info')
 
     def days_to_set_are_all_timeofuse(self):
         # Verify that all the days requested to be updated in the schedule fall within time of use days
@@ -481,17 +658,18 @@ class Ecobee:
                 logger.warning('One or more days to set falls outside the time of use day range.\n'
                                'timeofuse_restricted is set to \'False\', allowing thermostat update.')
 
-        thermostat_response_temp = self.get_thermostats(self.selection)
-        thermostat_schedule_temp = thermostat_response_temp[self.thermostat_index].program.schedule
-        thermostat_climates_temp = thermostat_response_temp[self.thermostat_index].program.climates
+        # Only fetch the program to compare against
+        thermostat_program_temp = self.get_thermostats(self.get_profile_selection('program'))[0].program
+        current_fingerprint = fingerprint.ProgramFingerprint(thermostat_program_temp)
+        new_fingerprint = fingerprint.ProgramFingerprint(self.thermostat_object.program)
 
-        if thermostat_schedule_temp == self.thermostat_schedule:
-            logger.debug('The schedule is already up to date, checking climates.')
-            if len(helpers.compare_nested_structures(thermostat_climates_temp, self.thermostat_climates)) == 0:
-                # No updates necessary
-                logger.debug('The climates are already already up to date, no changes necessary.')
-                return False
+        if current_fingerprint == new_fingerprint:
+            # No updates necessary
+            logger.debug('The climates and schedule are already up to date, no changes necessary.')
+            return False
 
+        for change in current_fingerprint.get_delta(new_fingerprint):
+            logger.info(f'Program change: {change}')
         return True
 
     def update_thermostat(self, force=False):
@@ -499,17 +677,14 @@ class Ecobee:
             return 0
 
         logger.info('Updating thermostats...')
-        update_thermostat_response = self.ecobee_service.update_thermostats(
+        thermostat_rev = self.thermostat_object.thermostat_rev
+        update_thermostat_response = self._client.update_thermostats(
             selection=self.selection,
             thermostat=Thermostat(identifier=self.thermostat_identifier, program=Program(
                 schedule=self.thermostat_schedule, climates=self.thermostat_climates)))
 
         if update_thermostat_response.status.code == 0:
-            # After update a sleep is required for ecobee API to process the request
-            time.sleep(10)
-
-            # Update the thermostat object
-            self.thermostat_list = self.selection
+            self.refresh_after_update(thermostat_rev, profile='program')
 
             logger.info('Successfully updated thermostats.')
             logger.info(update_thermostat_response.pretty_format())
@@ -518,35 +693,56 @@ class Ecobee:
             logger.error(f'Failure while executing update_thermostats:\n{update_thermostat_response.pretty_format()}')
             return -1
 
-    def set_new_climate_names(self, create=False, notify=False):
-        # ToDo: Modify to not create the entire climate set, just create what
-        #  is needed to set the days_to_set program values.
+    def get_required_climate_names(self):
+        # Climates referenced by the program get_program_values() will produce for days_to_set
+        if not self.during_supercool_months:
+            return []
+
+        required_names = []
+        for daynum in self.days_to_set:
+            if self.high_temp_list[daynum] is None or self.supercool_cutoff > self.get_day_temp_high(daynum):
+                continue
+
+            required_names.extend(f'{climate_name_prefix}{daynum}' for climate_name_prefix in
+                                  self.new_climate_prefixes)
+
+            # Previous nights sleep climate
+            if self.lookahead or daynum == self.tomorrow_daynum:
+                required_names.append(f'{self.new_climate_prefixes[-1]}{(daynum - 1) % 7}')
+
+        return list(dict.fromkeys(required_names))
+
+    def set_new_climate_names(self, create=False, notify=False, batch_size=None, required_only=True):
+        # With create, returns the result of create_new_climates() (negative when climates are missing)
         self.new_climate_names = [f'{climate_name_prefix}{i}' for climate_name_prefix in
                                   self.new_climate_prefixes for i in range(7)]
 
         if create:
-            return_value = self.create_new_climates()
+            # Only create the climates needed for days_to_set, remaining climates are created by the
+            # run that first needs them
+            names = self.get_required_climate_names() if required_only else self.new_climate_names
+            return_value = self.create_new_climates(names=names, batch_size=batch_size)
             if return_value > 0:
                 # Success
                 if notify:
-                    helpers.send_notifications('Ecobee Climate Creation (Success)',
-                                               'Successfully created all new thermostat climates.')
+                    self.send_notifications('Ecobee Climate Creation (Success)',
+                                               f'Successfully created {return_value} new thermostat climates.')
                 else:
-                    logger.info('Successfully created all new thermostat climates.')
+                    logger.info(f'Successfully created {return_value} new thermostat climates.')
             elif return_value < 0:
                 # Failure
                 if notify:
-                    helpers.send_notifications('Ecobee Climate Creation (Failure)',
-                                               'Failure creating thermostat climates.')
+                    self.send_notifications('Ecobee Climate Creation (Failure)',
+                                               'Failure creating thermostat climates.', severity='error')
                 else:
                     logger.error('Failure creating thermostat climates.')
             else:
                 # No climates created
                 logger.info('All climates already exist, nothing to create.')
+            return return_value
 
     def set_thermostat_climates(self, program, update=False, notify=False):
         title = message = None
-        climates = self.thermostat_climates
 
         # check if program is empty
         if not any(program):
@@ -561,12 +757,10 @@ class Ecobee:
             logger.debug(f'Setting climates for {helpers.get_day_name(idx)}.')
 
             for climate_slot in day:
-                climate_ref = climate_slot[0]
+                climate = self.get_climate(climate_ref=climate_slot[0])
                 climate_temp = climate_slot[1]
-                for climate in climates:
-                    if climate.climate_ref.lower() == climate_ref.lower():
-                        if climate_temp > 0:
-                            climate.cool_temp = climate_temp
+                if climate is not None and climate_temp > 0:
+                    climate.cool_temp = climate_temp
 
         if update:
             logger.info('Attempting to update thermostat climates.')
@@ -589,12 +783,21 @@ class Ecobee:
                 logger.error(message)
 
             if notify and title is not None:
-                helpers.send_notifications(title, message)
+                self.send_notifications(title, message, severity='error' if return_value < 0 else 'info')
 
     def get_program_values(self, notify=False):
-        outdoor_temp_high = self.temp_high
-        logger.info(f'Tomorrow\'s outdoor high temperature will be {str(outdoor_temp_high)[0:-1]}.'
-                    f'{str(outdoor_temp_high)[-1]}{chr(176)}.')
+        if self.lookahead:
+            # Cutoff checks below use the hottest day, each day is checked again when it's set
+            day_temps = [self.high_temp_list[daynum] for daynum in self.days_to_set
+                         if self.high_temp_list[daynum] is not None]
+            outdoor_temp_high = max(day_temps) if day_temps else forecast.UNKNOWN_TEMP
+            for daynum in self.days_to_set:
+                logger.info(f'{helpers.get_day_name(daynum)}\'s outdoor high temperature will be '
+                            f'{helpers.int_to_degreestring(self.get_day_temp_high(daynum))}{chr(176)}.')
+        else:
+            outdoor_temp_high = self.temp_high
+            logger.info(f'Tomorrow\'s outdoor high temperature will be {str(outdoor_temp_high)[0:-1]}.'
+                        f'{str(outdoor_temp_high)[-1]}{chr(176)}.')
 
         # Create empty program
         program = []
@@ -602,7 +805,7 @@ class Ecobee:
             program.append([])
 
         # Validate supercool values
-        if not isinstance(self.supercool_values, dict):
+        if not len(self.supercool_values):
             logger.error('This function needs a dictionary of supercool program values.')
             return program
 
@@ -638,7 +841,7 @@ class Ecobee:
                           f' need supercooling!\n'
 
                 if notify:
-                    helpers.send_notifications(title, message)
+                    self.send_notifications(title, message)
 
             logger.info(message)
 
@@ -655,45 +858,56 @@ class Ecobee:
                 logger.info(message)
 
                 if notify:
-                    helpers.send_notifications(title, message)
+                    self.send_notifications(title, message, severity='warning')
 
-        for daynum in self.days_to_set:
+        # Starting from tomorrow so a previous night is always set before the day it belongs to
+        for daynum in sorted(self.days_to_set, key=lambda x: (x - self.tomorrow_daynum) % 7):
             # Check if we have high temp for this day
             if self.high_temp_list[daynum] is None:
                 logger.warning(f'There is no high temperature for {helpers.get_day_name(daynum)}, '
                                f'skipping setting this day.')
                 continue
 
-            # Handle setting prior nights sleep climate (only gets set if 'tomorrow' for day value)
+            day_temp_high = self.get_day_temp_high(daynum)
+            if self.supercool_cutoff > day_temp_high:
+                logger.info(f'Supercool cutoff not met for {helpers.get_day_name(daynum)}, '
+                            f'skipping setting this day.')
+                continue
+
+            band = self.supercool_values.get_band(day_temp_high)
+            if band is None:
+                logger.warning(f'No supercool temperature band covers an outdoor high of {day_temp_high} '
+                               f'({self.supercool_values.low}-{self.supercool_values.high}), '
+                               f'skipping setting {helpers.get_day_name(daynum)}.')
+                continue
+
+            # Handle setting prior nights sleep climate (tomorrow, or every day in lookahead mode)
             if daynum - 1 >= 0:
                 previous_daynum = daynum - 1
             else:
                 previous_daynum = 6
             climate_ref_previous = self.get_climate_ref(name=f'{self.new_climate_prefixes[-1]}{previous_daynum}')
 
-            # Loop through supercool program values
-            for sc_temp in self.supercool_values.keys():
-                temp_list = helpers.get_range_from_string(sc_temp)
-                if temp_list[0] <= outdoor_temp_high <= temp_list[1]:
-                    for idx, slot in enumerate(self.supercool_values[sc_temp]):
-                        climate_ref = self.get_climate_ref(name=f'{self.new_climate_prefixes[idx]}{daynum}')
-
-                        program[daynum].append([climate_ref, slot[0], slot[1]])
-
-                    # Set previous sleep night to match the mornings sleep temp
-                    # ToDo: Modify this to work with any day, not just tomorrow
-                    #  Will require pulling outdoor temp on a per day basis
-                    if daynum == self.tomorrow_daynum:
-                        program[previous_daynum] = [[climate_ref_previous,
-                                                     self.supercool_values[sc_temp][0][0],
-                                                     self.supercool_values[sc_temp][-2][1]]]
-
-                    # Handle last day of time of use
-                    if daynum == self.timeofuse_days[-1]:
-                        logger.info('Last day of time of use detected, override sleep temp.')
-                        program[daynum][-1] = [self.get_climate_ref(name=f'{self.new_climate_prefixes[-1]}{daynum}'),
-                                               self.supercool_values[sc_temp][-2][0],
-                                               ""]
+            # Replace a previous night entry left by the following day
+            program[daynum] = []
+            for idx, slot in enumerate(band.values):
+                climate_ref = self.get_climate_ref(name=f'{self.new_climate_prefixes[idx]}{daynum}')
+
+                program[daynum].append([climate_ref, slot[0], slot[1]])
+
+            # Set previous sleep night to match the mornings sleep temp
+            if len(program[previous_daynum]) > 1:
+                # The previous day is set in this run as well, its last climate runs at this mornings sleep temp
+                program[previous_daynum][-1][1] = band.values[0][0]
+            elif self.lookahead or daynum == self.tomorrow_daynum:
+                program[previous_daynum] = [[climate_ref_previous, band.values[0][0], band.values[-2][1]]]
+
+            # Handle last day of time of use
+            if daynum == self.timeofuse_days[-1]:
+                logger.info('Last day of time of use detected, override sleep temp.')
+                program[daynum][-1] = [self.get_climate_ref(name=f'{self.new_climate_prefixes[-1]}{daynum}'),
+                                       band.values[-2][0],
+                                       ""]
 
         if not any(program):
             logger.error('No program values returned, exiting')
@@ -717,63 +931,104 @@ class Ecobee:
                                                 )
                                         )
 
-    def create_new_climates(self):
-        if self.new_climate_names is None:
+    def remove_new_climates(self, names):
+        # Remove climates added locally that ecobee never assigned a climateRef
+        names = set(names)
+        self.thermostat_climates[:] = [climate for climate in self.thermostat_climates
+                                       if climate.climate_ref is not None or climate.name not in names]
+
+    def remove_duplicate_climates(self):
+        # Ecobee occasionally assigns an existing climateRef to a new climate (API serialization error).
+        # Drop every climate whose climateRef was already seen so it can be recreated, returns the dropped names.
+        seen_refs = set()
+        climates = []
+        duplicates = []
+        for climate in self.thermostat_climates:
+            if climate.climate_ref in seen_refs:
+                logger.warning(f'Duplicate climateRef found: {climate.name}')
+                duplicates.append(climate.name)
+                continue
+            seen_refs.add(climate.climate_ref)
+            climates.append(climate)
+
+        if duplicates:
+            self.thermostat_climates[:] = climates
+        return duplicates
+
+    def create_new_climates(self, names=None, batch_size=None):
+        if names is None:
+            names = self.new_climate_names
+        if names is None:
             logger.warning('No new climate names found, returning.')
             return
 
-        climates_created = []
-        climates_exist = []
-
-        for climate in self.new_climate_names:
-            successful = False
-            while not successful:
-                duplicate = False
-                if self.get_climate_ref(name=climate) is None:
-                    # Climate missing, add it
-                    self.add_thermostat_climate(name=climate)
-
-                    # Update the thermostat with new climate
-                    # Note: Ecobee API only lets you add a single climate per API call
-                    self.update_thermostat(force=True)
-
-                    # check no duplicate climateRef properties exist (ecobee API serialization error)
-                    for idx, temp_climate in enumerate(self.thermostat_climates):
-                        if idx + 1 < len(self.thermostat_climates) and idx - 1 >= 0:
-                            if temp_climate.climate_ref == self.thermostat_climates[idx - 1].climate_ref or \
-                                    temp_climate.climate_ref == self.thermostat_climates[idx - 2].climate_ref:
-                                logger.warning(f'Duplicate climateRef found: {temp_climate.name}')
-                                # ToDo: Need to determine a proper fix, the climate will need to be recreated
-                                duplicate = True
-                                break
-
-                    # duplicate found, repeat loop
-                    if duplicate:
-                        logger.debug(f'Duplicate climateRef found for climate {climate}, '
-                                     f'repeating climate creation loop')
-                        continue
-
-                    # no duplicate climateRef found
-                    logger.info(f'Successfully created climate: {climate}')
-                    climates_created.append(climate)
-                    successful = True
-                else:
-                    # climate already exists
-                    logger.debug(f'Climate already exists: {climate}')
-                    climates_exist.append(climate)
-                    successful = True
+        # Push as many missing climates per update_thermostats call as ecobee accepts, halving the batch
+        # size whenever a write is rejected or does not create every climate sent. Returns the number of climates
+        # created, -1 when some could not be created.
+        missing = []
+        for climate in names:
+            if self.get_climate_ref(name=climate) is None:
+                missing.append(climate)
+            else:
+                logger.debug(f'Climate already exists: {climate}')
 
-        if len(climates_exist) + len(climates_created) == len(self.new_climate_names):
+        if batch_size is None:
+            batch_size = len(missing)
+        climates_created = []
+        round_trips = 0
+        repair_pending = False
+        attempts = 0
+        while (missing or repair_pending) and attempts < self.CLIMATE_CREATE_MAX_ATTEMPTS:
+            attempts += 1
+            batch = missing[:max(batch_size, 1)]
+            for climate in batch:
+                self.add_thermostat_climate(name=climate)
+
+            logger.debug(f'Creating {len(batch)} climate(s): {", ".join(batch)}')
+            if self.update_thermostat(force=True) < 0:
+                # Drop the rejected climates so they're never sent (or cached) without a climateRef
+                self.remove_new_climates(batch)
+                if len(batch) == 1:
+                    break
+                batch_size = max(len(batch) // 2, 1)
+                logger.debug(f'Climate write rejected, reducing batch size to {batch_size}')
+                continue
+            round_trips += 1
+
+            # Repair duplicate climateRefs in one pass, the removal is sent with the next write
+            duplicates = set(self.remove_duplicate_climates())
+            repair_pending = len(duplicates) > 0
+
+            created = [climate for climate in batch
+                       if climate not in duplicates and self.get_climate_ref(name=climate) is not None]
+            for climate in created:
+                logger.info(f'Successfully created climate: {climate}')
+            climates_created.extend(created)
+            created_names = set(created)
+            missing = [climate for climate in missing if climate not in created_names]
+            if len(created) < len(batch):
+                batch_size = max(len(batch) // 2, 1)
+                logger.debug(f'Not all climates were created, reducing batch size to {batch_size}')
+
+        logger.info(f'Climate creation used {round_trips} update_thermostats call(s) '
+                    f'for {len(climates_created)} climate(s).')
+
+        if not missing and not repair_pending:
             # Success
             return len(climates_created)
         else:
             # Failure
             return -1
 
-    def create_vacation(self, name, start_date, end_date, cool_temp, heat_temp=45, force=False):
+    def create_vacation(self, name, start_date, end_date, cool_temp, heat_temp=45, force=False, refresh=True):
+        return self._create_vacation(name, start_date, end_date, cool_temp, heat_temp=heat_temp, force=force,
+                                     refresh=refresh) > 0
+
+    def _create_vacation(self, name, start_date, end_date, cool_temp, heat_temp=45, force=False, refresh=True):
+        # Returns 1 when the vacation was created, 0 when skipped and -1 on failure
         if not self.timezone:
             logger.error('No time zone, set your timezone on the ecobee website')
-            return False
+            return -1
 
         tz = timezone(self.timezone)
         # Subtract a day from off-peak (vacation) start date to handle the previous nights sleep climate override
@@ -783,21 +1038,22 @@ class Ecobee:
         # Check if end_date is in the past
         if end_date < datetime.today():
             logger.info(f'Off-peak vacation "{name}" occurs in the past, skipping creation')
-            return False
+            return 0
 
         # Check if event (vacation) already exists
         if self.event_exist(name) and force:
             logger.info(f'Off-peak vacation "{name}" already exists, deleting existing vacation')
             # Delete the vacation
-            if not self.delete_vacation(name=name):
+            if not self.delete_vacation(name=name, refresh=refresh):
                 logger.warning(f'Unable to delete off-peak vacation "{name}"')
-                return False
+                return -1
         elif self.event_exist(name):
             logger.info(f'Off-peak vacation "{name}" already exists')
-            return False
+            return 0
 
         logger.info(f'Creating off-peak vacation "{name}"')
-        update_thermostat_response = self.ecobee_service.create_vacation(
+        thermostat_rev = self.thermostat_object.thermostat_rev
+        update_thermostat_response = self._client.create_vacation(
             name=name,
             cool_hold_temp=cool_temp,
             heat_hold_temp=heat_temp,
@@ -809,37 +1065,182 @@ class Ecobee:
             fan_min_on_time=0)
 
         if update_thermostat_response.status.code == 0:
-            # After update a sleep is required for ecobee API to process the request
-            time.sleep(10)
-
-            # Update the thermostat object
-            self.thermostat_list = self.selection
+            if refresh:
+                self.refresh_after_update(thermostat_rev, profile='events')
 
+            self.set_vacation_created(name, True)
             logger.info('Successfully created off-peak vacation(s)')
             logger.info(update_thermostat_response.pretty_format())
-            return True
+            return 1
         else:
             logger.error(f'Failure creating off-peak vacation:\n{update_thermostat_response.pretty_format()}')
-            return False
+            return -1
 
-    def delete_vacation(self, name):
+    def delete_vacation(self, name, refresh=True):
         if not self.event_exist(name):
             logger.info(f'Off-peak vacation "{name}" does not exist, nothing to do')
             return True
 
         logger.info(f'Deleting off-peak vacation "{name}"')
-        update_thermostat_response = self.ecobee_service.delete_vacation(name=name)
+        thermostat_rev = self.thermostat_object.thermostat_rev
+        update_thermostat_response = self._client.delete_vacation(name=name)
 
         if update_thermostat_response.status.code == 0:
-            # After update a sleep is required for ecobee API to process the request
-            time.sleep(10)
-
-            # Update the thermostat object
-            self.thermostat_list = self.selection
+            if refresh:
+                self.refresh_after_update(thermostat_rev, profile='events')
+            else:
+                # Keep the local events in step until the next refresh
+                self.thermostat_events[:] = [event for event in self.thermostat_events
+                                             if event.name.lower() != name.lower()]
 
+            self.set_vacation_created(name, False)
             logger.info('Successfully deleted off-peak vacation.')
             logger.info(update_thermostat_response.pretty_format())
             return True
         else:
             logger.error(f'Failure deleting off-peak vacation:\n{update_thermostat_response.pretty_format()}')
             return False
+
+    @property
+    def created_vacations(self):
+        # Vacations this tool created (recorded in the snapshot cache), vacations added in the ecobee app are never
+        # deleted even when they're named after a date
+        if self._created_vacations is None:
+            self._created_vacations = cache.load_vacations(self.thermostat_identifier, file_name=self.cache_file) \
+                if self.cache_file is not None else set()
+        return self._created_vacations
+
+    def set_vacation_created(self, name, created):
+        if created:
+            self.created_vacations.add(name)
+        elif name in self.created_vacations:
+            self.created_vacations.discard(name)
+        else:
+            return
+        if self.cache_file is not None:
+            cache.persist_vacations(self.thermostat_identifier, self.created_vacations, file_name=self.cache_file)
+
+    def stage_program(self, program):
+        # Apply program climate temps and schedule slots locally, written by commit()
+        if not any(program):
+            logger.info('No program updates, nothing staged.')
+            return
+
+        self.set_thermostat_climates(program=program)
+        self.set_thermostat_schedule(program=program)
+        self._program_staged = True
+
+    def stage_vacation(self, name, start_date, end_date, cool_temp, heat_temp=45, force=False):
+        self._staged_vacations[name] = dict(start_date=start_date, end_date=end_date, cool_temp=cool_temp,
+                                            heat_temp=heat_temp, force=force)
+
+    def stage_delete_vacation(self, name):
+        self._staged_vacations[name] = None
+
+    def reconcile_vacations(self, holidays, start_time, end_time, cool_temp, heat_temp=45):
+        # Diff the off-peak holidays against the thermostat's events in one pass and stage the missing
+        # vacations plus the removal of stale ones (vacations this tool created for a date that has passed or is no
+        # longer a holiday). commit() writes them back to back with one events refresh.
+        now = datetime.today()
+        desired = {}
+        for holiday_date in holidays:
+            # YYYY-MM-DD strings or the dates parsed by config.Config
+            holiday_date = holiday_date.strip() if isinstance(holiday_date, str) else holiday_date.isoformat()
+            if not holiday_date:
+                continue
+            if datetime.strptime(f'{holiday_date} {end_time}', '%Y-%m-%d %H:%M') < now:
+                logger.debug(f'Off-peak vacation "{holiday_date}" occurs in the past, skipping creation')
+                continue
+            desired[holiday_date.lower()] = holiday_date
+
+        existing = set()
+        deletes = 0
+        for event in self.thermostat_events or []:
+            if event.type != 'vacation' or helpers.parse_date(event.name) is None:
+                # Only vacations created for off-peak holidays are managed
+                continue
+            if event.name.lower() in desired:
+                existing.add(event.name.lower())
+                continue
+            if event.name not in self.created_vacations:
+                logger.debug(f'Vacation "{event.name}" was not created for an off-peak holiday, leaving it')
+                continue
+            logger.info(f'Off-peak vacation "{event.name}" is no longer a current holiday, staging removal')
+            self.stage_delete_vacation(event.name)
+            deletes += 1
+
+        creates = 0
+        for key, holiday_date in desired.items():
+            if key in existing:
+                logger.debug(f'Off-peak vacation "{holiday_date}" already exists')
+                continue
+            self.stage_vacation(name=holiday_date,
+                                start_date=f'{holiday_date} {start_time}',
+                                end_date=f'{holiday_date} {end_time}',
+                                cool_temp=cool_temp,
+                                heat_temp=heat_temp)
+            creates += 1
+
+        logger.info(f'Off-peak vacations: {creates} to create, {deletes} to delete, {len(existing)} up to date.')
+        return creates, deletes
+
+    def commit(self, notify=False):
+        # Flush staged changes with as few API calls as possible: one program write, the vacation
+        # writes back to back and a single events refresh. Returns 1 when changes were made, 0 when
+        # nothing changed and -1 if anything failed.
+        changes = []
+        failures = []
+
+        if self._program_staged:
+            logger.info('Attempting to update the thermostat program.')
+            return_value = self.update_thermostat()
+            if return_value > 0:
+                changes.append('Successfully updated thermostat climates and schedule.')
+            elif return_value == 0:
+                logger.info('No changes made to the program.')
+            else:
+                failures.append(f'Failure updating thermostat program --- {return_value}.')
+
+        thermostat_rev = self.thermostat_object.thermostat_rev
+        vacations_changed = False
+        for name, vacation in self._staged_vacations.items():
+            if vacation is None:
+                if not self.event_exist(name):
+                    logger.info(f'Off-peak vacation "{name}" does not exist, nothing to do')
+                elif self.delete_vacation(name=name, refresh=False):
+                    vacations_changed = True
+                    changes.append(f'Deleted off-peak vacation "{name}".')
+                else:
+                    failures.append(f'Failure deleting off-peak vacation "{name}".')
+                continue
+
+            return_value = self._create_vacation(name, refresh=False, **vacation)
+            if return_value > 0:
+                vacations_changed = True
+                changes.append(f'Created off-peak vacation "{name}".')
+            elif return_value < 0:
+                failures.append(f'Failure creating off-peak vacation "{name}".')
+
+        if vacations_changed:
+            self.refresh_after_update(thermostat_rev, profile='events')
+
+        self._program_staged = False
+        self._staged_vacations = {}
+
+        if failures:
+            title = 'Ecobee program (Error)'
+            message = '\n'.join(failures + changes)
+            logger.error(message)
+            return_value = -1
+        elif changes:
+            title = 'Ecobee program (Success)'
+            message = '\n'.join(changes)
+            logger.info(message)
+            return_value = 1
+        else:
+            logger.info('No changes made to the thermostat.')
+            return 0
+
+        if notify:
+            self.send_notifications(title, message, severity='error' if return_value < 0 else 'info')
+        return return_value
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+import signal
+import threading
+from datetime import datetime, timedelta
+from ecobee import config, core, helpers, logger, pipeline, tokens
+
+
+def get_next_run(run_times, now=None):
+    # run_times are local (hour, minute) times (config.Config.run_times) or a comma separated list of "HH:MM"
+    # times, returns the next one after now
+    if now is None:
+        now = datetime.now()
+    if isinstance(run_times, str):
+        run_times = config.Config.parse_run_times(run_times)
+
+    next_runs = []
+    for hour, minute in run_times:
+        next_run = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if next_run <= now:
+            next_run += timedelta(days=1)
+        next_runs.append(next_run)
+    return min(next_runs)
+
+
+class Daemon(object):
+    def __init__(self, settings):
+        """
+        Keeps the ecobee service (tokens) and thermostat snapshot in memory and runs the supercool
+        pipeline at settings.daemon_run_times. SIGTERM/SIGINT stop the daemon, SIGHUP reloads settings.
+        """
+        self.settings = config.get_config(settings)
+        if not self.settings.run_times:
+            raise ValueError('daemon_run_times is not set.')
+        self.ecobee_service = None
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._reload = False
+
+    def handle_stop(self, signum, frame):
+        logger.info(f'Received signal {signum}, shutting down.')
+        self._stop.set()
+        self._wake.set()
+
+    def handle_reload(self, signum, frame):
+        logger.info('Received SIGHUP, reloading settings.')
+        self._reload = True
+        self._wake.set()
+
+    def reload_settings(self):
+        # An unchanged settings file returns the already compiled config, invalid settings keep the current ones
+        try:
+            settings = config.load(self.settings.file_name)
+            if not settings.run_times:
+                raise ValueError('daemon_run_times is not set.')
+        except Exception as e:
+            logger.error(f'Unable to reload settings, keeping the current settings: {e}')
+            return
+        if settings is self.settings:
+            logger.info('Settings unchanged.')
+            return
+
+        thermostat_name = self.settings.thermostat_name
+        self.settings = config.configure(settings)
+        if self.settings.thermostat_name != thermostat_name:
+            self.ecobee_service = core.authenticate(self.settings.thermostat_name)
+        logger.info('Settings reloaded.')
+
+    def run_pipeline(self):
+        # With a digest window, notifications from every run in the window are sent together
+        if getattr(self.settings, 'notification_digest_window', 0) > 0:
+            helpers.start_digest(self.settings)
+
+        try:
+            pipeline.run(self.settings, ecobee_service=self.ecobee_service)
+        except (Exception, SystemExit) as e:
+            # Keep the daemon alive, the next scheduled run will try again
+            logger.exception(f'Supercool pipeline failed: {e}')
+
+    def get_wait(self, next_run):
+        # Seconds until the next run or until the open digest window closes, whichever is first
+        wait = (next_run - datetime.now()).total_seconds()
+        digest = helpers.get_digest()
+        if digest is not None:
+            wait = min(wait, max(self.settings.notification_digest_window - digest.age(), 0))
+        return wait
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGHUP, self.handle_reload)
+
+        # authenticate() starts the background token refresh for the account
+        self.ecobee_service = core.authenticate(self.settings.thermostat_name)
+
+        while not self._stop.is_set():
+            # A SIGHUP received at any point (including during a run) is handled here, the event is cleared first
+            # so a signal arriving after the check still cuts the wait short
+            self._wake.clear()
+            if self._reload:
+                self._reload = False
+                self.reload_settings()
+
+            next_run = get_next_run(self.settings.run_times)
+            logger.info(f'Next supercool run at {next_run:%Y-%m-%d %H:%M}.')
+            if self._wake.wait(self.get_wait(next_run)):
+                continue
+
+            digest = helpers.get_digest()
+            if digest is not None and digest.age() >= self.settings.notification_digest_window:
+                helpers.flush_digest()
+            if datetime.now() >= next_run:
+                self.run_pipeline()
+
+        tokens.stop_refreshers()
+        helpers.flush_digest()
+        if self.settings.notifications_enabled:
+            from ecobee import outbox
+            outbox.flush()
+        logger.info('Daemon stopped.')
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+from ecobee import helpers
+
+# Climate fields written by this program, anything else ecobee returns is ignored when comparing
+CLIMATE_FIELDS = ['name', 'climate_ref', 'cool_temp', 'heat_temp', 'cool_fan', 'heat_fan', 'is_occupied',
+                  'is_optimized', 'owner', 'ventilator_min_on_time']
+
+
+def get_hash(value):
+    return hashlib.blake2b(repr(value).encode('utf-8'), digest_size=16).hexdigest()
+
+
+def normalize_climate(climate):
+    # Canonical, order-stable tuple of the fields we write, sensors are compared by id
+    values = tuple(getattr(climate, field) for field in CLIMATE_FIELDS)
+    sensors = tuple(sorted(str(sensor.id) for sensor in climate.sensors or []))
+    return values + (sensors,)
+
+
+def get_climate_key(climate):
+    # New climates have no climateRef until ecobee assigns one
+    return climate.climate_ref or f'name:{climate.name}'
+
+
+class ProgramFingerprint(object):
+    def __init__(self, program):
+        """
+        Hashes of each climate (keyed by climateRef) and each schedule day of an ecobee program
+        """
+        self.program = program
+        self.climates = {get_climate_key(climate): get_hash(normalize_climate(climate))
+                         for climate in program.climates or []}
+        self.schedule = [get_hash(tuple(day)) for day in program.schedule or []]
+
+    @property
+    def digest(self):
+        # Single hash of the whole program
+        return get_hash((sorted(self.climates.items()), self.schedule))
+
+    def changed_climates(self, other):
+        return sorted(key for key in set(self.climates) | set(other.climates)
+                      if self.climates.get(key) != other.climates.get(key))
+
+    def changed_days(self, other):
+        days = max(len(self.schedule), len(other.schedule))
+        return [daynum for daynum in range(days)
+                if daynum >= len(self.schedule) or daynum >= len(other.schedule) or
+                self.schedule[daynum] != other.schedule[daynum]]
+
+    def __eq__(self, other):
+        return self.climates == other.climates and self.schedule == other.schedule
+
+    def __ne__(self, other):
+        return not self == other
+
+    def get_delta(self, other):
+        # Field level differences between this (current) program and other (new), only built once the
+        # fingerprints differ
+        delta = []
+        current_climates = {get_climate_key(climate): climate for climate in self.program.climates or []}
+        new_climates = {get_climate_key(climate): climate for climate in other.program.climates or []}
+        for key in self.changed_climates(other):
+            current = current_climates.get(key)
+            new = new_climates.get(key)
+            if current is None:
+                delta.append(f'Climate {new.name}: added')
+                continue
+            if new is None:
+                delta.append(f'Climate {current.name}: removed')
+                continue
+
+            for field, current_value, new_value in zip(CLIMATE_FIELDS + ['sensors'], normalize_climate(current),
+                                                       normalize_climate(new)):
+                if current_value != new_value:
+                    delta.append(f'Climate {new.name}: {field} {current_value} -> {new_value}')
+
+        current_schedule = self.program.schedule or []
+        new_schedule = other.program.schedule or []
+        for daynum in self.changed_days(other):
+            current_day = current_schedule[daynum] if daynum < len(current_schedule) else []
+            new_day = new_schedule[daynum] if daynum < len(new_schedule) else []
+            slots = sum(1 for idx in range(max(len(current_day), len(new_day)))
+                        if idx >= len(current_day) or idx >= len(new_day) or current_day[idx] != new_day[idx])
+            delta.append(f'Schedule {helpers.get_day_name(daynum)}: {slots} slot(s) changed')
+
+        return delta
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from ecobee import config, logger, pipeline
+
+DEFAULT_MAX_WORKERS = 4
+
+
+def get_fleet_settings(base_settings, fleet):
+    # Each fleet entry is a dict of local_settings overrides for one thermostat, anything not
+    # overridden falls back to base_settings. Every entry is compiled and validated before any runs, entries
+    # are compiled once per base config.
+    base_settings = config.get_config(base_settings)
+    return [base_settings.derive(overrides) for overrides in fleet]
+
+
+def run_thermostat(settings):
+    start = time.monotonic()
+    result = {'thermostat_name': settings.thermostat_name, 'status': 'error', 'error': None}
+    try:
+        return_value = pipeline.run(settings)
+        if return_value is not None and return_value < 0:
+            result['error'] = 'One or more thermostat updates failed'
+        else:
+            result['status'] = 'updated' if return_value else 'unchanged'
+    except (Exception, SystemExit) as e:
+        # Isolate failures so one home can't stop the rest of the fleet
+        logger.exception(f'Supercool pipeline failed for thermostat "{settings.thermostat_name}"')
+        result['error'] = str(e) or e.__class__.__name__
+    result['duration'] = time.monotonic() - start
+    return result
+
+
+def run_fleet(fleet_settings, max_workers=None):
+    # Run the pipeline for every thermostat concurrently, at most max_workers at a time
+    if max_workers is None:
+        max_workers = DEFAULT_MAX_WORKERS
+
+    start = time.monotonic()
+    results = []
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='fleet') as executor:
+        futures = [executor.submit(run_thermostat, settings) for settings in fleet_settings]
+        for future in as_completed(futures):
+            results.append(future.result())
+
+    log_report(results, time.monotonic() - start)
+    return results
+
+
+def log_report(results, duration):
+    failures = [result for result in results if result['status'] == 'error']
+    logger.info(f'Fleet run finished in {duration:.1f} seconds: {len(results) - len(failures)} succeeded, '
+                f'{len(failures)} failed.')
+    for result in sorted(results, key=lambda x: x['thermostat_name']):
+        line = f'  {result["thermostat_name"]}: {result["status"]} ({result["duration"]:.1f}s)'
+        if result['error']:
+            logger.error(f'{line} - {result["error"]}')
+        else:
+            logger.info(line)
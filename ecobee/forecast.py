@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+from pytz import timezone, UnknownTimeZoneError
+from ecobee import logger
+
+UNKNOWN_TEMP = 9999  # Returned for days without a forecast, ecobee provides 4 days after today
+
+Forecast = namedtuple('Forecast', ['date', 'weekday', 'high', 'low', 'condition'])
+
+
+def get_today(time_zone=None):
+    # Today's date at the thermostat, the server's date when the time zone isn't known
+    if time_zone:
+        try:
+            return datetime.now(timezone(time_zone)).date()
+        except UnknownTimeZoneError:
+            logger.warning(f'Unknown thermostat time zone "{time_zone}", using the local date.')
+    return datetime.today().date()
+
+
+class ForecastIndex(object):
+    def __init__(self, weather_forecasts, time_zone=None):
+        """
+        Forecasts parsed once per snapshot, looked up by calendar date or weekday
+        """
+        self.time_zone = time_zone
+        self.today = get_today(time_zone)
+        self.by_date = {}
+        self.by_weekday = {}
+        for weather_forecast in weather_forecasts or []:
+            date = datetime.strptime(weather_forecast.date_time, '%Y-%m-%d %H:%M:%S').date()
+            forecast = Forecast(date, date.weekday(), weather_forecast.temp_high, weather_forecast.temp_low,
+                                weather_forecast.condition)
+            self.by_date.setdefault(date, forecast)
+            if date >= self.today:
+                # Weekdays refer to today and the coming days, at most one of each in the forecast
+                self.by_weekday.setdefault(forecast.weekday, forecast)
+
+    @property
+    def tomorrow(self):
+        return self.today + timedelta(days=1)
+
+    def get(self, date):
+        return self.by_date.get(date)
+
+    def get_weekday(self, weekday):
+        return self.by_weekday.get(weekday)
+
+    def get_high(self, weekday=None, date=None):
+        forecast = self.get(date) if date is not None else self.get_weekday(weekday)
+        return forecast.high if forecast is not None else UNKNOWN_TEMP
+
+    def get_high_temps(self):
+        # High temp for each weekday (Monday = 0) of the coming days (not today), None when there's no forecast
+        high_temps = [None] * 7
+        for forecast in self.by_weekday.values():
+            if forecast.date > self.today:
+                high_temps[forecast.weekday] = forecast.high
+        return high_temps
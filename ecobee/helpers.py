@@ -3,38 +3,21 @@
 import os
 import sys
 import calendar
-import local_settings
+import threading
 from datetime import datetime, timedelta
-from ecobee import notifications, logger
-from deepdiff import DeepDiff
+from ecobee import logger
+
+_digests = threading.local()
 
 
 def get_script_dir():
     return os.path.abspath(os.path.dirname(sys.argv[0]))
 
 
-def get_time_slot(start_time, end_time=''):
-    date_format = '%H:%M'
-
-    schedule_start = datetime.strptime('00:00', date_format)  # compare to beginning of the day
-    start_time = datetime.strptime(start_time, date_format)
-    if not end_time:
-        end_time = start_time + timedelta(minutes=30)
-    else:
-        end_time = datetime.strptime(end_time, date_format)
-        if end_time < start_time:
-            raise Exception('End time can not be before start time')
-
-    start_slot = ((start_time - schedule_start).seconds / 60 / 60 / .5)
-    end_slot = ((end_time - schedule_start).seconds / 60 / 60 / .5)
-    if start_slot.is_integer() and end_slot.is_integer():
-        return int(start_slot), int(end_slot)
-
-
-def get_day_number(day):
-    # Verify friendly name
+def get_day_number(day, today=None):
+    # Verify friendly name, today defaults to the server's date
     if day.lower() == 'tomorrow':
-        return (datetime.today() + timedelta(days=1)).weekday()
+        return ((today or datetime.today()) + timedelta(days=1)).weekday()
 
     # Day number check
     if day.isdigit():
@@ -49,44 +32,62 @@ def get_day_number(day):
     return daynum
 
 
-def get_day_slots(days):
-    day_set = set()
-    for day in days.split(','):
-        if day.lower() == 'weekdays':
-            day_set.update([0, 1, 2, 3, 4])
-        elif day.lower() == 'weekend':
-            day_set.update([5, 6])
-        elif day.lower() == 'tomorrow':
-            day_set.add((datetime.today() + timedelta(days=1)).weekday())
-        else:
-            daynum = get_day_number(day)
-            if daynum not in day_set:
-                day_set.add(daynum)
-    return list(day_set)
-
-
 def get_day_name(daynum):
     return calendar.day_name[daynum]
 
 
-def send_notifications(title, message):
-    if local_settings.email_enabled:
-        logger.info(u"Sending Email notification")
-        email_to = local_settings.email_to
-        email = notifications.Email()
-        email.notify(email_to, title, message)
-    if local_settings.pushbullet_enabled:
-        logger.info(u"Sending PushBullet notification")
-        pushbullet = notifications.PUSHBULLET()
-        pushbullet.notify(title, message)
-    if local_settings.pushover_enabled:
-        logger.info(u"Sending Pushover notification")
-        prowl = notifications.PUSHOVER()
-        prowl.notify(title, message)
-    if local_settings.join_enabled:
-        logger.info(u"Sending Join notification")
-        join = notifications.JOIN()
-        join.notify(title, message)
+def get_notification_channels(settings=None):
+    # Enabled channels (config.Channel) are resolved once when the settings are compiled, settings defaults to the
+    # configured settings
+    if settings is None:
+        from ecobee import config
+        settings = config.get_settings()
+    return settings.notification_channels
+
+
+def send_notifications(title, message, severity='info', channels=None):
+    # While a digest is open notifications are collected and sent as one message by flush_digest(),
+    # errors always go out immediately. channels are the config.Channel of the run (a fleet entry may override
+    # them), the configured settings' channels when not given.
+    digest = getattr(_digests, 'digest', None)
+    if digest is not None and severity != 'error':
+        logger.debug(f'Adding notification to digest: {title}')
+        digest.add(title, message)
+        return
+
+    # Queue the notification in the durable outbox, delivery happens in the background (or on the next run)
+    from ecobee import outbox
+
+    if channels is None:
+        channels = get_notification_channels()
+    if channels:
+        logger.info(f'Queueing {", ".join(channel.name for channel in channels)} notification(s)')
+        outbox.enqueue(channels, title, message)
+
+
+def start_digest(settings=None):
+    # Digests are per thread so concurrent fleet runs don't mix their notifications, the digest is sent to the
+    # channels of the settings it was started with. Returns False if a digest is already open.
+    from ecobee import config, notifications
+
+    if settings is None:
+        settings = config.get_settings()
+    if not getattr(settings, 'notification_digest', True) or getattr(_digests, 'digest', None) is not None:
+        return False
+
+    _digests.digest = notifications.Digest(channels=settings.notification_channels)
+    return True
+
+
+def get_digest():
+    return getattr(_digests, 'digest', None)
+
+
+def flush_digest():
+    digest = getattr(_digests, 'digest', None)
+    _digests.digest = None
+    if digest is not None and digest.entries:
+        send_notifications(*digest.build(), channels=digest.channels)
 
 
 def get_range_from_string(x):
@@ -97,8 +98,72 @@ def get_range_from_string(x):
     return result
 
 
-def compare_nested_structures(l1, l2, ignore_case=False, ignore_order=False):
-    return DeepDiff(l1, l2, ignore_string_case=ignore_case, ignore_order=ignore_order)
+def parse_date(value, date_format='%Y-%m-%d'):
+    # Returns the datetime for value, None if value isn't a date in date_format
+    try:
+        return datetime.strptime(value, date_format)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_revision(revision):
+    # Thermostat summary revision format:
+    #   identifier:name:connected:thermostatRevision:alertsRevision:runtimeRevision:intervalRevision
+    keys = ['identifier', 'name', 'connected', 'thermostat', 'alerts', 'runtime', 'interval']
+    return dict(zip(keys, revision.split(':')))
+
+
+def merge_ecobee_objects(target, source):
+    # Copy every attribute returned in a partial response onto the existing object
+    for attribute_name in source.slots():
+        attribute_value = getattr(source, attribute_name)
+        if attribute_value is not None:
+            setattr(target, attribute_name, attribute_value)
+    return target
+
+
+class ObjectIndex(object):
+    def __init__(self, attribute_name):
+        """
+        Case-insensitive dict index over a list of ecobee objects (e.g. climates by name)
+        """
+        self.attribute_name = attribute_name
+        self._objects = None
+        self._length = None
+        self._index = {}
+
+    def sync(self, objects):
+        # Rebuild when the list was replaced (snapshot refresh) or grew/shrank (climate appended or removed)
+        if objects is self._objects and (objects is None or len(objects) == self._length):
+            return
+        self._index = {}
+        for obj in objects or []:
+            key = getattr(obj, self.attribute_name)
+            if key is not None:
+                # First match wins, same as scanning the list
+                self._index.setdefault(key.lower(), obj)
+        self._objects = objects
+        self._length = len(objects) if objects is not None else None
+
+    def get(self, objects, key):
+        self.sync(objects)
+        return self._index.get(key.lower()) if key is not None else None
+
+
+def snapshot_property(method):
+    # Property computed on first use and kept in the owner's _snapshot dict, the owner clears the dict as a group
+    # whenever its snapshot changes
+    name = method.__name__
+
+    def getter(self):
+        try:
+            return self._snapshot[name]
+        except KeyError:
+            value = self._snapshot[name] = method(self)
+            return value
+
+    getter.__name__ = name
+    return property(getter)
 
 
 def int_to_degreestring(i):
@@ -1,24 +1,38 @@
-import local_settings
+import atexit
 import json
-import smtplib
-import email.utils
-from ecobee import logger
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from urllib.request import urlopen, Request
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from ecobee import config, logger
 from urllib.parse import urlencode, quote_plus
 
-logger.initLogger(logfile=local_settings.logfile, loglevel=local_settings.loglevel)
+DEFAULT_TIMEOUT = 10  # Seconds allowed per connect/read for a single channel
+DEFAULT_RETRIES = 2  # Retries per channel after a failed send
+DEFAULT_BUDGET = 30  # Max seconds the caller waits for all channels
+RETRY_DELAY = 1  # Seconds before the first retry, doubles on each retry
+MAX_WORKERS = 4
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    # Created on the first dispatch, importing the module starts no threads
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='notify')
+        return _executor
 
 
 class PUSHBULLET(object):
-    def __init__(self):
-        self.apikey = local_settings.pushbullet_apikey
-        self.deviceid = local_settings.pushbullet_deviceid
+    def __init__(self, options, timeout=DEFAULT_TIMEOUT):
+        self.timeout = timeout
+        self.apikey = options['apikey']
+        self.deviceid = options.get('deviceid')
 
     def notify(self, title, message):
-        if not local_settings.pushbullet_enabled:
-            return
+        from urllib.request import urlopen, Request
 
         url = "https://api.pushbullet.com/v2/pushes"
 
@@ -34,7 +48,7 @@ class PUSHBULLET(object):
                                     self.apikey}
 
         request = Request(url, urlencode(json.dumps(data)).encode('utf-8'), headers)
-        response = urlopen(request)
+        response = urlopen(request, timeout=self.timeout)
 
         if response is not None:
             try:
@@ -51,21 +65,22 @@ class PUSHBULLET(object):
 
 
 class JOIN(object):
-    def __init__(self):
+    def __init__(self, options, timeout=DEFAULT_TIMEOUT):
+        self.timeout = timeout
 
-        self.enabled = local_settings.join_enabled
-        self.apikey = local_settings.join_apikey
-        self.deviceid = local_settings.join_deviceid
+        self.apikey = options['apikey']
+        self.deviceid = options.get('deviceid')
         self.url = 'https://joinjoaomgcd.appspot.com/_ah/' \
                    'api/messaging/v1/sendPush?apikey={apikey}' \
                    '&title={title}&text={text}' \
                    '&icon={icon}'
 
     def notify(self, title, message):
-        if not local_settings.join_enabled or \
-                not local_settings.join_apikey:
+        if not self.apikey:
             return
 
+        from urllib.request import urlopen
+
         if not self.deviceid:
             self.deviceid = "group.all"
         devid = [x.strip() for x in self.deviceid.split(',')]
@@ -77,7 +92,8 @@ class JOIN(object):
         response = urlopen(self.url.format(apikey=self.apikey,
                                            title=quote_plus(title),
                                            text=quote_plus(message.encode("utf-8")),
-                                           deviceid=self.deviceid))
+                                           deviceid=self.deviceid),
+                           timeout=self.timeout)
 
         if response:
             logger.info(u"Join notifications sent.")
@@ -88,30 +104,27 @@ class JOIN(object):
 
 
 class PUSHOVER(object):
-    def __init__(self):
-        self.enabled = local_settings.pushover_enabled
-        self.keys = local_settings.pushover_keys
-        self.priority = local_settings.pushover_priority
-
-        if local_settings.pushover_apitoken:
-            self.application_token = local_settings.pushover_apitoken
+    def __init__(self, options, timeout=DEFAULT_TIMEOUT):
+        self.timeout = timeout
+        self.keys = options['keys']
+        self.priority = options.get('priority')
+        self.application_token = options['apitoken']
 
     def notify(self, title, message):
-        if not local_settings.pushover_enabled:
-            return
+        from urllib.request import urlopen, Request
 
         url = "https://api.pushover.net/1/messages.json"
 
         data = {'token': self.application_token,
-                'user': local_settings.pushover_keys,
+                'user': self.keys,
                 'title': title,
                 'message': message.encode("utf-8"),
-                'priority': local_settings.pushover_priority}
+                'priority': self.priority}
 
         headers = {'Content-type': "application/x-www-form-urlencoded"}
 
         request = Request(url, urlencode(data).encode('utf-8'), headers)
-        response = urlopen(request)
+        response = urlopen(request, timeout=self.timeout)
 
         if response:
             logger.info(u"Pushover notifications sent.")
@@ -121,48 +134,219 @@ class PUSHOVER(object):
             return False
 
 
+class SMTPSession(object):
+    def __init__(self):
+        """
+        Authenticated SMTP connection kept open for the whole run (or daemon lifetime) and shared
+        by every Email, reconnects when the server has dropped the session or the email options changed
+        """
+        self._mailserver = None
+        self._server_key = None
+        self._lock = threading.Lock()
+        self._close_registered = False
+
+    @staticmethod
+    def get_server_key(options):
+        # The Email channel options (config.Channel.options) that identify the server and account
+        return (options.get('ssl'), options['smtp_server'], options['smtp_port'], options.get('tls'),
+                options.get('smtp_user'), options.get('smtp_password'))
+
+    def connect(self, options, timeout):
+        # smtplib is imported when an email is sent, most runs never send one
+        import smtplib
+
+        if options.get('ssl'):
+            mailserver = smtplib.SMTP_SSL(
+                options['smtp_server'],
+                options['smtp_port'],
+                timeout=timeout)
+        else:
+            mailserver = smtplib.SMTP(options['smtp_server'],
+                                      options['smtp_port'],
+                                      timeout=timeout)
+
+        mailserver.ehlo()
+
+        if options.get('tls'):
+            mailserver.starttls()
+
+        mailserver.ehlo()
+
+        if options.get('smtp_user'):
+            mailserver.login(options['smtp_user'],
+                             options.get('smtp_password'))
+
+        self._mailserver = mailserver
+        self._server_key = self.get_server_key(options)
+        if not self._close_registered:
+            # Close the session at exit, registered once there is one to close
+            atexit.register(self.close)
+            self._close_registered = True
+
+    def is_connected(self, options):
+        if self._mailserver is None or self._server_key != self.get_server_key(options):
+            return False
+
+        import smtplib
+        try:
+            return self._mailserver.noop()[0] == 250
+        except smtplib.SMTPException:
+            return False
+        except OSError:
+            return False
+
+    def send(self, messages, options, timeout):
+        # messages is a list of (to, message) pairs, all sent over one connection
+        import smtplib
+
+        with self._lock:
+            if not self.is_connected(options):
+                self.close_server()
+                self.connect(options, timeout)
+
+            for to, message in messages:
+                try:
+                    self._mailserver.sendmail(options['from'], to.split(','), message.as_string())
+                except smtplib.SMTPServerDisconnected:
+                    # Session went stale mid batch, reconnect once and resend
+                    self.connect(options, timeout)
+                    self._mailserver.sendmail(options['from'], to.split(','), message.as_string())
+
+    def close_server(self):
+        if self._mailserver is None:
+            return
+
+        import smtplib
+        try:
+            self._mailserver.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        self._mailserver = None
+
+    def close(self):
+        with self._lock:
+            self.close_server()
+
+
+smtp_session = SMTPSession()
+
+
 class Email(object):
-    def notify(self, to, subject, body):
-        """Send out our HTML email"""
+    def __init__(self, options, timeout=DEFAULT_TIMEOUT):
+        self.options = options
+        self.timeout = timeout
+
+    def build_message(self, to, subject, body):
+        # The email package is only imported once an email is sent
+        from email.mime.multipart import MIMEMultipart
+        from email.mime.text import MIMEText
+        import email.utils
 
         # message = MIMEMultipart('alternative')
         message = MIMEMultipart()
         html_body = MIMEText(body, 'html')
         message['Subject'] = subject
         message['From'] = email.utils.formataddr(
-            ('pyecobee-supercool', local_settings.email_from))
+            ('pyecobee-supercool', self.options['from']))
         message['To'] = to
         message['Date'] = email.utils.formatdate(localtime=True)
         message.preamble = "Preamble"
         message.attach(html_body)
+        return message
+
+    def notify(self, to, subject, body):
+        """Send out our HTML email"""
+        return self.notify_batch([(to, subject, body)])
 
+    def notify_batch(self, emails):
+        """Send several (to, subject, body) HTML emails over the shared SMTP session"""
         try:
-            if local_settings.email_ssl:
-                mailserver = smtplib.SMTP_SSL(
-                    local_settings.email_smtp_server,
-                    local_settings.email_smtp_port)
-            else:
-                mailserver = smtplib.SMTP(local_settings.email_smtp_server,
-                                          local_settings.email_smtp_port)
+            smtp_session.send([(to, self.build_message(to, subject, body)) for to, subject, body in emails],
+                              self.options, self.timeout)
+            return True
 
-            mailserver.ehlo()
+        except Exception as e:
+            logger.error('Unable to send Email: %s' % e)
+            return False
 
-            if local_settings.email_tls:
-                mailserver.starttls()
 
-            mailserver.ehlo()
+class Digest(object):
+    def __init__(self, channels=None):
+        """
+        Collects the notifications produced during a run (or daemon window) so they go out as one message
+        """
+        self.channels = channels
+        self.started = time.monotonic()
+        self.entries = []
 
-            if local_settings.email_smtp_user:
-                mailserver.login(local_settings.email_smtp_user,
-                                 local_settings.email_smtp_password)
+    def add(self, title, message):
+        self.entries.append((title, message))
 
-            mailserver.sendmail(local_settings.email_from,
-                                to.split(','),
-                                message.as_string())
+    def age(self):
+        return time.monotonic() - self.started
+
+    def build(self):
+        # Returns the combined (title, message), a single notification is passed through unchanged
+        if len(self.entries) == 1:
+            return self.entries[0]
+
+        title = f'Ecobee supercool ({len(self.entries)} notifications)'
+        message = '\n\n'.join(f'{title}\n{message}' for title, message in self.entries)
+        return title, message
 
-            mailserver.quit()
-            return True
 
+def get_sender(channel, title, message, options):
+    # Returns a callable taking a timeout that sends the notification to a single channel, options are the
+    # channel's settings (config.Channel.options) of the run that produced the notification
+    if channel == 'Email':
+        return lambda timeout: Email(options, timeout=timeout).notify(options['to'], title, message)
+    if channel == 'PushBullet':
+        return lambda timeout: PUSHBULLET(options, timeout=timeout).notify(title, message)
+    if channel == 'Pushover':
+        return lambda timeout: PUSHOVER(options, timeout=timeout).notify(title, message)
+    if channel == 'Join':
+        return lambda timeout: JOIN(options, timeout=timeout).notify(title, message)
+    raise ValueError(f'Unknown notification channel: {channel}')
+
+
+def send_with_retries(channel, send, retries):
+    for attempt in range(retries + 1):
+        try:
+            if send():
+                return True
         except Exception as e:
-            logger.error('Unable to send Email: %s' % e)
-            return False
+            logger.error(f'{channel} notification failed: {e}')
+
+        if attempt < retries:
+            time.sleep(RETRY_DELAY * 2 ** attempt)
+    return False
+
+
+def dispatch(channels, timeout=None, retries=None, budget=None, on_done=None):
+    """
+    Send to every channel in parallel, channels maps a channel name to a callable that takes a timeout and
+    returns True once sent. Waits at most budget seconds and returns a dict of channel name to
+    'sent', 'failed' or 'timeout' (still sending in the background).
+    on_done(channel, sent) is called when each send finishes, including the ones that outlast the budget.
+    """
+    settings = config.get_settings()
+    timeout = timeout if timeout is not None else getattr(settings, 'notification_timeout', DEFAULT_TIMEOUT)
+    retries = retries if retries is not None else getattr(settings, 'notification_retries', DEFAULT_RETRIES)
+    budget = budget if budget is not None else getattr(settings, 'notification_budget', DEFAULT_BUDGET)
+
+    executor = get_executor()
+    futures = {channel: executor.submit(send_with_retries, channel, lambda send=send: send(timeout), retries)
+               for channel, send in channels.items()}
+    if on_done is not None:
+        for channel, future in futures.items():
+            future.add_done_callback(lambda future, channel=channel: on_done(channel, future.result()))
+    wait(futures.values(), timeout=budget)
+
+    results = {}
+    for channel, future in futures.items():
+        if not future.done():
+            logger.warning(f'{channel} notification still sending after {budget} seconds, continuing.')
+            results[channel] = 'timeout'
+        else:
+            results[channel] = 'sent' if future.result() else 'failed'
+    return results
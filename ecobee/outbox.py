@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sqlite3
+import threading
+import time
+from ecobee import config, helpers, logger, notifications
+
+DEFAULT_MAX_ATTEMPTS = 5  # Delivery attempts before a notification is dead-lettered
+RETRY_DELAY = 30  # Seconds before the first redelivery, doubles after every failed attempt
+WORKER_INTERVAL = 60  # Seconds between background delivery passes
+LEASE_TIME = 600  # Seconds a claimed notification may stay in flight before its sender is assumed to be gone
+RETENTION = 7 * 24 * 3600  # Seconds sent and dead-lettered notifications are kept, and pending ones are retried
+ADDED_COLUMNS = {'lease_until': 'REAL', 'channel_key': 'TEXT'}  # Columns added after the outbox was first released
+
+_local = threading.local()
+_wake = threading.Event()
+_worker = None
+_worker_lock = threading.Lock()
+_channels = {}  # channel key -> config.Channel registered by this process, rows only store the key
+_channels_lock = threading.Lock()
+
+
+def get_outbox_file():
+    return f'{helpers.get_script_dir()}/pyecobee_outbox.db'
+
+
+def connect(file_name=None):
+    # One connection per thread and outbox file, WAL keeps enqueue cheap while the worker is delivering
+    if file_name is None:
+        file_name = get_outbox_file()
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    if file_name not in connections:
+        # Notifications can be personal, only the user may read the outbox (sqlite gives -wal/-shm the same mode)
+        if not os.path.exists(file_name):
+            os.close(os.open(file_name, os.O_CREAT | os.O_WRONLY, 0o600))
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(f'{file_name}{suffix}'):
+                os.chmod(f'{file_name}{suffix}', 0o600)
+
+        connection = sqlite3.connect(file_name, timeout=30)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute('PRAGMA secure_delete=ON')
+        connection.execute('CREATE TABLE IF NOT EXISTS outbox ('
+                           'id INTEGER PRIMARY KEY, channel TEXT, title TEXT, message TEXT, '
+                           'status TEXT DEFAULT \'pending\', attempts INTEGER DEFAULT 0, created REAL, '
+                           'next_attempt REAL, delivered REAL, last_error TEXT, lease_until REAL, channel_key TEXT)')
+        columns = [row[1] for row in connection.execute('PRAGMA table_info(outbox)')]
+        for column, column_type in ADDED_COLUMNS.items():
+            if column not in columns:
+                connection.execute(f'ALTER TABLE outbox ADD COLUMN {column} {column_type}')
+        if 'options' in columns:
+            # Outboxes of an earlier version stored the channel options, API keys and passwords included
+            connection.execute('ALTER TABLE outbox DROP COLUMN options')
+            connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        connection.execute('CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (status, next_attempt)')
+        connections[file_name] = connection
+    return connections[file_name]
+
+
+def get_channel_key(channel):
+    # Identifies a config.Channel (name and options) without storing its options, they include API keys and
+    # passwords
+    return config.get_hash(repr((channel.name, sorted(channel.options.items()))).encode('utf-8'))
+
+
+def register(channels):
+    # Channels (config.Channel) this process can deliver to, notifications queued for other channels (another
+    # fleet entry's, or settings since changed) are left to the process that has them until RETENTION runs out
+    with _channels_lock:
+        for channel in channels:
+            _channels[get_channel_key(channel)] = channel
+
+
+def enqueue(channels, title, message, file_name=None):
+    # channels are config.Channel, the notification is delivered with the options of the run that produced it
+    register(channels)
+    now = time.time()
+    connection = connect(file_name)
+    with connection:
+        connection.executemany('INSERT INTO outbox (channel, title, message, channel_key, created, next_attempt) '
+                               'VALUES (?, ?, ?, ?, ?, ?)',
+                               [(channel.name, title, message, get_channel_key(channel), now, now)
+                                for channel in channels])
+    start_worker()
+
+
+def claim(connection, max_attempts):
+    # Moves the due notifications to 'sending' in one write transaction so another worker or process never picks
+    # up the same row. A row still 'sending' after its lease belonged to a process that died mid-send, it may
+    # have been delivered so it's dead-lettered instead of sent again.
+    # Only rows for channels registered by this process are claimed. Rows older than RETENTION are dropped once
+    # finished, or dead-lettered when still pending.
+    now = time.time()
+    with _channels_lock:
+        channel_keys = list(_channels)
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        connection.execute('DELETE FROM outbox WHERE status IN (\'sent\', \'dead\') AND created < ?',
+                           (now - RETENTION,))
+        for row_id, channel, title in connection.execute('SELECT id, channel, title FROM outbox '
+                                                         'WHERE status = \'pending\' AND created < ?',
+                                                         (now - RETENTION,)).fetchall():
+            logger.error(f'{channel} notification "{title}" could not be delivered in time, dead-lettered.')
+            connection.execute('UPDATE outbox SET status = \'dead\', last_error = ? WHERE id = ?',
+                               ('expired', row_id))
+        for row_id, channel, title in connection.execute('SELECT id, channel, title FROM outbox '
+                                                         'WHERE status = \'sending\' AND lease_until <= ?',
+                                                         (now,)).fetchall():
+            logger.error(f'{channel} notification "{title}" was interrupted while sending, dead-lettered.')
+            connection.execute('UPDATE outbox SET status = \'dead\', last_error = ? WHERE id = ?',
+                               ('interrupted', row_id))
+        rows = connection.execute(f'SELECT id, channel, title, message, channel_key, attempts, created FROM outbox '
+                                  f'WHERE status = \'pending\' AND next_attempt <= ? '
+                                  f'AND channel_key IN ({", ".join("?" * len(channel_keys))}) ORDER BY id',
+                                  [now] + channel_keys).fetchall()
+        connection.executemany('UPDATE outbox SET status = \'sending\', attempts = attempts + 1, lease_until = ? '
+                               'WHERE id = ?', [(now + LEASE_TIME, row[0]) for row in rows])
+        connection.commit()
+    except BaseException:
+        connection.rollback()
+        raise
+    return [(row_id, channel, title, message, channel_key, attempts + 1, created, max_attempts)
+            for row_id, channel, title, message, channel_key, attempts, created in rows]
+
+
+def finish(row, sent, result, file_name=None):
+    # Records the outcome of a claimed notification, only a definite failure is retried
+    row_id, channel, title, message, channel_key, attempts, created, max_attempts = row
+    now = time.time()
+    connection = connect(file_name)
+    with connection:
+        if sent:
+            logger.info(f'{channel} notification delivered after {now - created:.1f} seconds.')
+            connection.execute('UPDATE outbox SET status = \'sent\', delivered = ?, lease_until = NULL '
+                               'WHERE id = ?', (now, row_id))
+        elif attempts >= max_attempts:
+            logger.error(f'{channel} notification "{title}" failed {attempts} times, dead-lettered.')
+            connection.execute('UPDATE outbox SET status = \'dead\', last_error = ?, lease_until = NULL '
+                               'WHERE id = ?', (result, row_id))
+        else:
+            connection.execute('UPDATE outbox SET status = \'pending\', next_attempt = ?, last_error = ?, '
+                               'lease_until = NULL WHERE id = ?',
+                               (now + RETRY_DELAY * 2 ** (attempts - 1), result, row_id))
+
+
+def deliver(file_name=None, max_attempts=None):
+    # Send every due notification once (with notification_retries quick retries), failures are retried with
+    # exponential backoff and dead-lettered after max_attempts. Waits at most notification_budget seconds, sends
+    # still running keep their claim and are recorded when they finish. Claims keep concurrent passes apart.
+    # Returns the number of notifications delivered.
+    if max_attempts is None:
+        max_attempts = getattr(config.get_settings(), 'notification_max_attempts', DEFAULT_MAX_ATTEMPTS)
+
+    rows = {f'{row[1]} #{row[0]}': row for row in claim(connect(file_name), max_attempts)}
+    if not rows:
+        return 0
+
+    senders = {}
+    for key, row in rows.items():
+        try:
+            senders[key] = notifications.get_sender(row[1], row[2], row[3], _channels[row[4]].options)
+        except ValueError as e:
+            logger.error(e)
+            finish(row, False, str(e), file_name=file_name)
+
+    def on_done(key, sent):
+        try:
+            finish(rows[key], sent, 'failed', file_name=file_name)
+        except Exception as e:
+            logger.exception(f'Unable to record {key} notification delivery: {e}')
+
+    results = notifications.dispatch(senders, on_done=on_done)
+    delivered = list(results.values()).count('sent')
+
+    report = stats(file_name)
+    logger.info(f'Outbox: {delivered} delivered, queue depth {report["pending"]}, {report["sending"]} sending, '
+                f'{report["dead"]} dead-lettered, average delivery latency {report["latency"]:.1f} seconds.')
+    return delivered
+
+
+def stats(file_name=None):
+    connection = connect(file_name)
+    counts = dict(connection.execute('SELECT status, COUNT(*) FROM outbox GROUP BY status').fetchall())
+    latency = connection.execute('SELECT AVG(delivered - created) FROM outbox WHERE status = \'sent\'').fetchone()[0]
+    return {'pending': counts.get('pending', 0),
+            'sending': counts.get('sending', 0),
+            'sent': counts.get('sent', 0),
+            'dead': counts.get('dead', 0),
+            'latency': latency or 0.0}
+
+
+def run_worker():
+    while True:
+        _wake.wait(WORKER_INTERVAL)
+        _wake.clear()
+        try:
+            deliver()
+        except Exception as e:
+            logger.exception(f'Outbox delivery failed: {e}')
+
+
+def start_worker():
+    # Background delivery thread for retries while the process keeps running, wakes it for an immediate pass.
+    # Runs call flush() before they return, the thread is not relied on to deliver anything at exit.
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            _worker = threading.Thread(target=run_worker, name='outbox', daemon=True)
+            _worker.start()
+    _wake.set()
+
+
+def flush(file_name=None):
+    # Delivery pass at the end of a run, called by the run itself while the notification executor is still alive
+    # (it's shut down by the time atexit handlers run). Waits at most notification_budget seconds, whatever is
+    # left is sent by the background worker or the next run.
+    try:
+        return deliver(file_name=file_name)
+    except Exception as e:
+        logger.exception(f'Outbox delivery failed: {e}')
+        return 0
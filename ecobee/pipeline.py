@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+from ecobee import cache, config, core, fingerprint, helpers, logger
+
+
+# Settings that change the program or vacations, a change to any of them invalidates the last applied plan
+PLAN_SETTINGS = ['climates', 'supercool_values', 'supercool_low_temp_cutoff', 'supercool_month_range', 'days_to_set',
+                 'timeofuse_day_range', 'timeofuse_restricted', 'timeofuse_holidays', 'timeofuse_holidays_cool_temp',
+                 'timeofuse_holidays_start_time', 'timeofuse_holidays_end_time']
+
+
+def run(settings, ecobee_service=None, force=False):
+    # Run the supercool pipeline for a single thermostat. settings is a compiled config.Config (or the
+    # local_settings module, compiled here). Long-running callers pass their already authenticated
+    # ecobee_service.
+    # Notifications produced during the run are sent as one digest at the end, unless the caller
+    # already opened a digest (daemon window).
+    # force skips the check against the last applied plan.
+    # The run's notifications are delivered before it returns.
+    settings = config.get_config(settings)
+    digest_started = helpers.start_digest(settings)
+    try:
+        return _run(settings, ecobee_service=ecobee_service, force=force)
+    finally:
+        if digest_started:
+            helpers.flush_digest()
+        if settings.notifications_enabled:
+            from ecobee import outbox
+            outbox.flush()
+
+
+def get_config_hash(settings):
+    values = []
+    for name in PLAN_SETTINGS:
+        value = getattr(settings, name, None)
+        values.append(sorted(value.items()) if isinstance(value, dict) else value)
+    return fingerprint.get_hash(values)
+
+
+def get_plan_key(thermostat, supercool_bands, config_hash):
+    # Everything the program and vacations are computed from. thermostat_rev changes whenever the program,
+    # settings or events are changed (by this program, the app or at the thermostat).
+    days = []
+    for daynum in thermostat.days_to_set:
+        temp_high = thermostat.get_day_temp_high(daynum)
+        band = supercool_bands.get_band(temp_high)
+        days.append((daynum,
+                     thermostat.high_temp_list[daynum] is not None,
+                     (band.low, band.high) if band is not None else None,
+                     thermostat.supercool_cutoff <= temp_high))
+    return (thermostat.thermostat_identifier,
+            thermostat.thermostat_object.thermostat_rev,
+            thermostat.during_supercool_months,
+            tuple(days),
+            config_hash)
+
+
+def plan_applied(thermostat, plan_key):
+    # The last plan was computed from the same inputs and the thermostat still has the program it wrote
+    plan = cache.load_plan(thermostat.thermostat_identifier, file_name=thermostat.cache_file)
+    if plan is None or plan['key'] != plan_key:
+        return False
+    return fingerprint.ProgramFingerprint(thermostat.thermostat_object.program).digest == plan['program']
+
+
+def _run(settings, ecobee_service=None, force=False):
+    notify = settings.notifications_enabled
+    if notify:
+        # Deliver notifications left in the outbox by earlier runs with the same channels, the outbox (sqlite3) is
+        # only loaded when notifications are enabled
+        from ecobee import outbox
+        outbox.register(settings.notification_channels)
+        outbox.start_worker()
+
+    # The supercool bands and the rest of the settings were compiled and validated before touching the API
+    supercool_bands = settings.supercool_bands
+
+    if ecobee_service is None:
+        ecobee_service = core.authenticate(settings.thermostat_name)
+
+    # Get thermostat list
+    thermostat = core.Ecobee(ecobee_service=ecobee_service,
+                             thermostat_name=settings.thermostat_name,
+                             timeofuse_days=settings.timeofuse_days,
+                             timeofuse_restricted=settings.timeofuse_restricted,
+                             days_to_set=(settings.lookahead, settings.sets_tomorrow, settings.fixed_days),
+                             supercool_cutoff=settings.supercool_low_temp_cutoff,
+                             new_climate_prefixes=list(settings.climate_prefixes),
+                             supercool_values=supercool_bands,
+                             supercool_months=settings.supercool_months,
+                             cache_file=cache.CACHE_FILE,
+                             notification_channels=settings.notification_channels)
+
+    plan_key = get_plan_key(thermostat, supercool_bands, get_config_hash(settings))
+    if not force and plan_applied(thermostat, plan_key):
+        logger.info(f'Thermostat "{thermostat.thermostat_name}" already has the program for this forecast and '
+                    f'configuration, no-op (cached).')
+        return 0
+
+    # Get unique climate names for each day and create climates
+    climates_created = thermostat.set_new_climate_names(create=True, notify=notify)
+
+    # Get program values based on outdoor high temp
+    program_values = thermostat.get_program_values(notify=notify)
+
+    # Stage program climates and schedule
+    thermostat.stage_program(program=program_values)
+
+    # Stage the vacation creates/deletes that bring the off-peak holidays up to date
+    thermostat.reconcile_vacations(holidays=settings.holidays,
+                                   start_time=settings.timeofuse_holidays_start_time,
+                                   end_time=settings.timeofuse_holidays_end_time,
+                                   cool_temp=settings.timeofuse_holidays_cool_temp)
+
+    # Write all staged changes
+    return_value = thermostat.commit(notify=notify)
+    if climates_created < 0:
+        # Days whose climates are missing weren't programmed, the plan isn't remembered so the next run retries
+        logger.error(f'Climates are missing on thermostat "{thermostat.thermostat_name}", the next run will retry.')
+        return -1
+    if return_value >= 0:
+        # Remember the plan, the next run with the same inputs has nothing to do
+        cache.persist_plan(thermostat.thermostat_identifier,
+                           get_plan_key(thermostat, supercool_bands, get_config_hash(settings)),
+                           fingerprint.ProgramFingerprint(thermostat.thermostat_object.program),
+                           file_name=thermostat.cache_file)
+    return return_value
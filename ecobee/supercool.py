@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+from collections import namedtuple
+from ecobee import helpers, logger, weekschedule
+
+Band = namedtuple('Band', ['low', 'high', 'values'])
+
+_compiled = {}  # (supercool_values, slot_count) -> SupercoolBands, configs are compiled once per process
+
+
+def get_bands(supercool_values, slot_count=None):
+    # Compile (or reuse the already compiled) supercool_values table
+    if isinstance(supercool_values, SupercoolBands):
+        return supercool_values
+
+    key = (repr(sorted(supercool_values.items())), slot_count)
+    bands = _compiled.get(key)
+    if bands is None:
+        bands = _compiled[key] = SupercoolBands(supercool_values, slot_count=slot_count)
+    return bands
+
+
+class SupercoolBands(object):
+    def __init__(self, supercool_values, slot_count=None):
+        """
+        Sorted interval index over the supercool_values temperature bands, validated when compiled
+        """
+        if not isinstance(supercool_values, dict):
+            raise ValueError('supercool_values must be a dictionary of "low-high" temperature bands.')
+
+        self.values = supercool_values
+        self.slot_count = slot_count
+        self._bands = sorted(self.compile_band(temp_range, values)
+                             for temp_range, values in supercool_values.items())
+        self._lows = [band.low for band in self._bands]
+        self.validate()
+
+    def compile_band(self, temp_range, values):
+        try:
+            low, high = helpers.get_range_from_string(temp_range)
+        except ValueError:
+            raise ValueError(f'Invalid supercool temperature band "{temp_range}", expected "low-high".')
+        if low > high:
+            raise ValueError(f'Supercool temperature band "{temp_range}" low is greater than high.')
+
+        if self.slot_count is not None and len(values) != self.slot_count:
+            raise ValueError(f'Supercool temperature band "{temp_range}" has {len(values)} slots, '
+                             f'climates has {self.slot_count}.')
+        if len(values) < 2:
+            raise ValueError(f'Supercool temperature band "{temp_range}" needs at least two slots.')
+
+        for idx, slot in enumerate(values):
+            # Every slot ends on a half hour except the last one which runs to the end of the day
+            end_time = slot[1]
+            if (idx < len(values) - 1 or end_time) and weekschedule.get_slot(end_time) is None:
+                raise ValueError(f'Supercool temperature band "{temp_range}" slot {idx} end time "{end_time}" '
+                                 f'is not on a half hour.')
+
+        return Band(low, high, [list(slot) for slot in values])
+
+    def validate(self):
+        # Overlapping bands make the lookup ambiguous, gaps silently produce no program for a temperature
+        for previous, band in zip(self._bands, self._bands[1:]):
+            if band.low <= previous.high:
+                raise ValueError(f'Supercool temperature bands {previous.low}-{previous.high} and '
+                                 f'{band.low}-{band.high} overlap.')
+            if band.low > previous.high + 1:
+                raise ValueError(f'Supercool temperature bands have a gap between {previous.high} and {band.low}.')
+
+    def check_cutoff(self, supercool_cutoff):
+        # Temperatures at or above the cutoff get programmed, warn when they aren't covered by a band
+        if self._bands and supercool_cutoff < self.low:
+            logger.warning(f'Outdoor highs from {supercool_cutoff} to {self.low - 1} pass the supercool cutoff '
+                           f'but have no supercool temperature band.')
+
+    @property
+    def low(self):
+        return self._bands[0].low if self._bands else None
+
+    @property
+    def high(self):
+        return self._bands[-1].high if self._bands else None
+
+    def get_band(self, temp):
+        # Band containing the outdoor high temp, None when it's outside every band
+        idx = bisect.bisect_right(self._lows, temp) - 1
+        if idx >= 0 and temp <= self._bands[idx].high:
+            return self._bands[idx]
+        return None
+
+    def __len__(self):
+        return len(self._bands)
+
+    def __iter__(self):
+        return iter(self._bands)
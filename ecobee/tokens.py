@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+
+import contextlib
+import hashlib
+import json
+import os
+import shelve
+import tempfile
+import threading
+import pytz
+from datetime import datetime, timedelta
+from pyecobee import EcobeeService
+from pyecobee.enumerations import Scope
+from ecobee import client, helpers, logger
+
+try:
+    import fcntl
+except ImportError:  # Windows, only threads within this process are serialized
+    fcntl = None
+
+TOKEN_FILE = f'{helpers.get_script_dir()}/pyecobee_tokens.json'
+LEGACY_DB_FILE = f'{helpers.get_script_dir()}/pyecobee_db'  # Pickled EcobeeService shelve of older versions
+TOKEN_LOCK = threading.Lock()  # Serializes writes to the store where there is no fcntl
+REFRESH_MARGIN = timedelta(minutes=5)  # Refresh the access token this long before it expires
+RETRY_INTERVAL = 60  # Seconds between background refresh attempts after a failure
+
+_refreshers = {}  # thermostat name -> TokenRefresher
+_refreshers_lock = threading.Lock()
+_account_locks = {}  # thermostat name -> Lock held while the account's tokens are refreshed
+_account_locks_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def _flocked(lock_file_name, exclusive):
+    # flock locks belong to the open file, so they also serialize the threads of this process
+    with open(lock_file_name, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+@contextlib.contextmanager
+def locked(file_name, exclusive=False):
+    # Readers share the lock, a writer (save) holds it alone across processes. Only held to read or write the
+    # store, never across a network call. Don't nest.
+    if fcntl is None:
+        # Writes replace the file in one rename, readers don't need a lock
+        with TOKEN_LOCK if exclusive else contextlib.nullcontext():
+            yield
+        return
+
+    with _flocked(f'{file_name}.lock', exclusive):
+        yield
+
+
+@contextlib.contextmanager
+def account_locked(thermostat_name, file_name):
+    # Held by the one thread (in any process) refreshing an account's tokens, other accounts and readers of the
+    # store aren't held up
+    with _account_locks_lock:
+        account_lock = _account_locks.setdefault(thermostat_name, threading.Lock())
+    with account_lock:
+        if fcntl is None:
+            yield
+            return
+
+        account_key = hashlib.blake2b(thermostat_name.encode('utf-8'), digest_size=8).hexdigest()
+        with _flocked(f'{file_name}.{account_key}.lock', True):
+            yield
+
+
+def _read(file_name):
+    try:
+        with open(file_name, 'r') as token_file:
+            return json.load(token_file)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        logger.error(f'Unable to read token store {file_name}, error: {e}')
+        return {}
+
+
+def _write(tokens, file_name):
+    # Write a temp file next to the store and rename it over the store, readers never see a partial file
+    directory = os.path.dirname(os.path.abspath(file_name))
+    file_descriptor, temp_name = tempfile.mkstemp(dir=directory, prefix='.pyecobee_tokens.')
+    try:
+        with os.fdopen(file_descriptor, 'w') as temp_file:
+            json.dump(tokens, temp_file, indent=2, sort_keys=True)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_name, file_name)
+    except Exception:
+        os.remove(temp_name)
+        raise
+
+
+def to_entry(ecobee_service):
+    def isoformat(value):
+        return value.isoformat() if value is not None else None
+
+    return {'application_key': ecobee_service.application_key,
+            'authorization_token': ecobee_service.authorization_token,
+            'access_token': ecobee_service.access_token,
+            'access_token_expires_on': isoformat(ecobee_service.access_token_expires_on),
+            'refresh_token': ecobee_service.refresh_token,
+            'refresh_token_expires_on': isoformat(ecobee_service.refresh_token_expires_on),
+            'scope': ecobee_service.scope.value}
+
+
+def parse_expiry(value):
+    return datetime.fromisoformat(value) if value else None
+
+
+def from_entry(thermostat_name, entry):
+    return EcobeeService(thermostat_name=thermostat_name,
+                         application_key=entry['application_key'],
+                         authorization_token=entry.get('authorization_token'),
+                         access_token=entry.get('access_token'),
+                         refresh_token=entry.get('refresh_token'),
+                         access_token_expires_on=parse_expiry(entry.get('access_token_expires_on')),
+                         refresh_token_expires_on=parse_expiry(entry.get('refresh_token_expires_on')),
+                         scope=Scope(entry.get('scope', Scope.SMART_WRITE.value)))
+
+
+def apply_entry(ecobee_service, entry):
+    # Copy tokens saved by another process onto a service already in use
+    ecobee_service.authorization_token = entry.get('authorization_token')
+    ecobee_service.access_token = entry.get('access_token')
+    ecobee_service.refresh_token = entry.get('refresh_token')
+    ecobee_service.access_token_expires_on = parse_expiry(entry.get('access_token_expires_on'))
+    ecobee_service.refresh_token_expires_on = parse_expiry(entry.get('refresh_token_expires_on'))
+
+
+def load_legacy(thermostat_name, db_file=None):
+    # One time import from the pickled shelve DB so existing installs don't have to authorize again
+    if db_file is None:
+        db_file = LEGACY_DB_FILE
+    if not any(os.path.exists(f'{db_file}{suffix}') for suffix in ('', '.db', '.dat')):
+        return None
+    try:
+        with shelve.open(db_file, flag='r', protocol=2) as pyecobee_db:
+            ecobee_service = pyecobee_db.get(thermostat_name)
+    except Exception as e:
+        logger.warning(f'Unable to read the legacy shelve DB {db_file}, error: {e}')
+        return None
+    if ecobee_service is not None:
+        logger.info(f'Importing the tokens for "{thermostat_name}" from {db_file}.')
+    return ecobee_service
+
+
+def load(thermostat_name, file_name=TOKEN_FILE, legacy_db_file=None):
+    # Returns an EcobeeService with the stored tokens, None when the thermostat has never been authorized.
+    # Tokens missing from the store are imported from legacy_db_file (LEGACY_DB_FILE by default).
+    with locked(file_name):
+        entry = _read(file_name).get(thermostat_name)
+    if entry is not None:
+        return from_entry(thermostat_name, entry)
+
+    ecobee_service = load_legacy(thermostat_name, db_file=legacy_db_file)
+    if ecobee_service is not None:
+        save(ecobee_service, file_name=file_name)
+    return ecobee_service
+
+
+def save(ecobee_service, file_name=TOKEN_FILE):
+    logger.debug(f'Token store: {file_name}')
+    with locked(file_name, exclusive=True):
+        tokens = _read(file_name)
+        tokens[ecobee_service.thermostat_name] = to_entry(ecobee_service)
+        _write(tokens, file_name)
+
+
+def needs_refresh(ecobee_service, margin=REFRESH_MARGIN):
+    return datetime.now(pytz.utc) + margin > ecobee_service.access_token_expires_on
+
+
+def refresh(ecobee_service, margin=REFRESH_MARGIN, file_name=TOKEN_FILE, force=False):
+    # Refresh the access token under the account's lock once it's within margin of expiring. If another
+    # thread or process refreshed it while we waited for the lock its tokens are used instead, so each token is
+    # refreshed exactly once. The store itself is only locked to read and save the tokens.
+    with account_locked(ecobee_service.thermostat_name, file_name):
+        with locked(file_name):
+            entry = _read(file_name).get(ecobee_service.thermostat_name)
+        if entry is not None and entry.get('access_token') != ecobee_service.access_token:
+            logger.debug(f'Using the access token for "{ecobee_service.thermostat_name}" saved by another process.')
+            apply_entry(ecobee_service, entry)
+        if not force and not needs_refresh(ecobee_service, margin=margin):
+            return False
+
+        # Sent over the account's pooled client like every other API call
+        token_response = client.get_client(ecobee_service).refresh_tokens()
+        logger.debug('TokenResponse returned from ecobee_service.refresh_tokens():\n{0}'.format(
+            token_response.pretty_format()))
+        save(ecobee_service, file_name=file_name)
+        return True
+
+
+class TokenRefresher(object):
+    def __init__(self, ecobee_service, file_name=TOKEN_FILE, margin=REFRESH_MARGIN):
+        """
+        Background thread refreshing an account's access token shortly before it expires
+        """
+        self.ecobee_service = ecobee_service
+        self.file_name = file_name
+        self.margin = margin
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.run, name=f'token-refresh-{ecobee_service.thermostat_name}',
+                                        daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def is_alive(self):
+        return self._thread.is_alive()
+
+    def run(self):
+        while not self._stop.is_set():
+            wait = (self.ecobee_service.access_token_expires_on - self.margin -
+                    datetime.now(pytz.utc)).total_seconds()
+            if self._stop.wait(max(wait, 0)):
+                break
+
+            try:
+                if datetime.now(pytz.utc) > self.ecobee_service.refresh_token_expires_on:
+                    logger.error(f'Refresh token for "{self.ecobee_service.thermostat_name}" expired, run main.py '
+                                 f'interactively to re-authorize.')
+                    break
+                logger.info('Access token expires soon, refreshing the token.')
+                refresh(self.ecobee_service, margin=self.margin, file_name=self.file_name)
+            except Exception as e:
+                logger.error(f'Unable to refresh the access token, error: {e}')
+                self._stop.wait(RETRY_INTERVAL)
+
+
+def start_refresher(ecobee_service, file_name=TOKEN_FILE):
+    # One refresher per account in this process, a re-authenticated service replaces the one being refreshed
+    with _refreshers_lock:
+        refresher = _refreshers.get(ecobee_service.thermostat_name)
+        if refresher is not None and refresher.is_alive():
+            refresher.ecobee_service = ecobee_service
+            return refresher
+        refresher = _refreshers[ecobee_service.thermostat_name] = TokenRefresher(ecobee_service,
+                                                                                 file_name=file_name).start()
+        return refresher
+
+
+def stop_refreshers():
+    with _refreshers_lock:
+        for refresher in _refreshers.values():
+            refresher.stop()
+        _refreshers.clear()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+DAYS = 7
+SLOTS_PER_DAY = 48  # 30 minute slots
+LAST_SLOT_TIME = '23:30'
+
+# "HH:MM" -> slot index for every half hour of the day, replaces parsing times with strptime
+SLOT_TABLE = {f'{slot // 2:02}:{slot % 2 * 30:02}': slot for slot in range(SLOTS_PER_DAY)}
+
+
+def get_slot(time_string):
+    # Returns the slot index for a "HH:MM" time, None if it doesn't fall on a half hour
+    return SLOT_TABLE.get(time_string)
+
+
+class WeekSchedule(object):
+    def __init__(self, climate_refs, slots):
+        """
+        Compact 7 x 48 schedule, each byte of slots is an index into climate_refs
+        """
+        self.climate_refs = climate_refs
+        self._ref_index = {climate_ref: idx for idx, climate_ref in enumerate(climate_refs)}
+        self.slots = slots
+
+    @classmethod
+    def from_ecobee(cls, schedule, default_climate_ref):
+        # Build from the ecobee schedule format (7 lists of 48 climateRefs), None gives a week of default
+        if schedule is None:
+            return cls([default_climate_ref], bytearray(DAYS * SLOTS_PER_DAY))
+
+        climate_refs = list(dict.fromkeys(climate_ref for day in schedule for climate_ref in day))
+        week = cls(climate_refs, None)
+        week.slots = bytearray(week._ref_index[climate_ref] for day in schedule for climate_ref in day)
+        return week
+
+    def copy(self):
+        return WeekSchedule(list(self.climate_refs), bytearray(self.slots))
+
+    def get_ref_index(self, climate_ref):
+        idx = self._ref_index.get(climate_ref)
+        if idx is None:
+            if len(self.climate_refs) > 255:
+                raise ValueError('A schedule can not reference more than 256 climates')
+            idx = self._ref_index[climate_ref] = len(self.climate_refs)
+            self.climate_refs.append(climate_ref)
+        return idx
+
+    def fill(self, daynum, start_slot, end_slot, climate_ref):
+        # Set slots [start_slot, end_slot) of a day to climate_ref in one slice assignment
+        if end_slot < start_slot:
+            raise ValueError('End slot can not be before start slot')
+        offset = daynum * SLOTS_PER_DAY
+        self.slots[offset + start_slot:offset + end_slot] = bytes([self.get_ref_index(climate_ref)]) * \
+            (end_slot - start_slot)
+
+    def apply_program_day(self, daynum, day):
+        # day is the list of [climateRef, cool temp, end time] slots produced by Ecobee.get_program_values()
+        last_time = '00:00'
+        for climate_slot in day:
+            climate_ref = climate_slot[0]
+
+            # For setting prior nights sleep climate
+            if len(climate_slot[2]) > 1:
+                if len(day) == 1:
+                    last_time = climate_slot[2]
+                    end_time = LAST_SLOT_TIME
+                else:
+                    end_time = climate_slot[2]
+            else:
+                end_time = LAST_SLOT_TIME
+
+            start_slot, end_slot = SLOT_TABLE[last_time], SLOT_TABLE[end_time]
+            if end_slot == SLOTS_PER_DAY - 1:
+                # Adjust for last slot of the day
+                end_slot += 1
+            self.fill(daynum, start_slot, end_slot, climate_ref)
+            last_time = end_time
+
+    def get_day(self, daynum):
+        return self.slots[daynum * SLOTS_PER_DAY:(daynum + 1) * SLOTS_PER_DAY]
+
+    def day_to_ecobee(self, daynum):
+        climate_refs = self.climate_refs
+        return [climate_refs[idx] for idx in self.get_day(daynum)]
+
+    def to_ecobee(self):
+        return [self.day_to_ecobee(daynum) for daynum in range(DAYS)]
+
+    def changed_days(self, other):
+        # Days that differ from another WeekSchedule. When other's climate indexes are a prefix of ours
+        # (e.g. other is an earlier copy of this schedule) each day is a single 48 byte compare.
+        if self.climate_refs[:len(other.climate_refs)] == other.climate_refs:
+            return [daynum for daynum in range(DAYS) if self.get_day(daynum) != other.get_day(daynum)]
+        return [daynum for daynum in range(DAYS) if self.day_to_ecobee(daynum) != other.day_to_ecobee(daynum)]
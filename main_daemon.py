@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+
+from ecobee import config, daemon, logger
+
+settings = config.configure(config.load())
+logger.initLogger(logfile=settings.logfile, loglevel=settings.loglevel)
+
+# Run the supercool pipeline at local_settings.daemon_run_times until stopped (SIGTERM), SIGHUP reloads settings
+daemon.Daemon(settings).run()
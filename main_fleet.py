@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+
+from ecobee import config, fleet, logger
+
+settings = config.configure(config.load())
+logger.initLogger(logfile=settings.logfile, loglevel=settings.loglevel)
+
+# Run the supercool pipeline for every thermostat listed in local_settings.fleet concurrently
+fleet.run_fleet(fleet.get_fleet_settings(settings, settings.fleet), max_workers=settings.fleet_max_workers)
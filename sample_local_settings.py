@@ -12,7 +12,7 @@ supercool_values = {
     "1120-1149": [[740, "09:00"], [710, "11:00"], [690, "16:00"], [820, "19:00"], [770, "22:00"], [740, ""]],
     "1150-1300": [[730, "08:00"], [700, "11:00"], [680, "16:00"], [820, "19:00"], [770, "22:00"], [730, ""]]
 }
-days_to_set = "tomorrow"
+days_to_set = "tomorrow"  # Or "lookahead" to set every forecast day using its own high temperature
 timeofuse_day_range = "0-4"
 timeofuse_restricted = True
 timeofuse_holidays = "2023-01-01," \
@@ -28,9 +28,21 @@ timeofuse_holidays = "2023-01-01," \
 timeofuse_holidays_cool_temp = 77
 timeofuse_holidays_start_time = "19:00"
 timeofuse_holidays_end_time = "19:00"
-supercool_low_temp_cutoff = 819
+supercool_low_temp_cutoff = 820
 supercool_month_range = "04-10"
 notifications_enabled = True
+notification_timeout = 10  # Seconds per connect/read for each notification channel
+notification_retries = 2  # Retries per channel after a failed send
+notification_budget = 30  # Max seconds a run waits for notifications, slower channels finish in the background
+notification_max_attempts = 5  # Delivery attempts before a queued notification is given up on
+notification_digest = True  # Combine the notifications from a run into one message, errors are sent immediately
+notification_digest_window = 0  # main_daemon.py only, seconds to collect notifications across runs (0 = per run)
+fleet = [  # Used by main_fleet.py, each entry overrides the settings above for one thermostat
+    {"thermostat_name": "Home"},
+    {"thermostat_name": "Cabin", "days_to_set": "weekdays"}
+]
+fleet_max_workers = 4
+daemon_run_times = "18:30"  # Used by main_daemon.py, comma separated local times to run at
 pushbullet_enabled = False
 pushbullet_apikey = ""
 pushbullet_deviceid = ""